@@ -1,4 +1,5 @@
 import os
+import time
 from tqdm import tqdm
 import warnings
 import torch
@@ -10,33 +11,20 @@ import random
 
 from utils.utils import clip_grad_norms, rotate_tensor
 from nets.actor_network import Actor
-from nets.critic_network import Critic
-from utils.utils import torch_load_cpu, get_inner_model, move_to, move_to_cuda, pad_solution
-from utils.logger import log_to_tb_train
-from agent.utils import validate
-
-class Memory:
-    def __init__(self):
-        self.actions = []
-        self.states = []
-        self.logprobs = []
-        self.rewards = []  
-        self.obj = []
-
-        
-    def clear_memory(self):
-        del self.actions[:]
-        del self.states[:]
-        del self.logprobs[:]
-        del self.rewards[:]
-        del self.obj[:]
-
+from nets.quantization import quantize_actor
+from utils.utils import torch_load_cpu, get_inner_model, move_to, pad_solution
+from utils.logger import log_to_tb_train_reinforce
+from agent.beam_search import beam_search
+from agent.utils import validate, get_val_stats, augment_batch, select_best_copy, StepTimeEstimate
 
 class Reinforce:
     def __init__(self, problem_name, size, opts):
         # figure out the options
         self.opts = opts
         
+        # model step time per batch shape, for the deadline-aware rollout
+        self.step_time = StepTimeEstimate()
+        
         # figure out the actor
         self.actor = Actor(
             problem_name = problem_name,
@@ -46,25 +34,17 @@ class Reinforce:
             n_layers = opts.n_encode_layers,
             normalization = opts.normalization,
             v_range = opts.v_range,
-            seq_length = size + 1
+            seq_length = size + 1,
+            rescore_k = opts.rescore_k,
+            precision = opts.precision,
+            checkpoint_activations = opts.checkpoint_activations
         )
         
         if not opts.eval_only:
         
-            # figure out the critic
-            self.critic = Critic(
-                    problem_name = problem_name,
-                    embedding_dim = opts.embedding_dim,
-                    hidden_dim = opts.hidden_dim,
-                    n_heads = opts.critic_head_num,
-                    n_layers = opts.n_encode_layers,
-                    normalization = opts.normalization
-                )
-        
-            # figure out the optimizer
+            # no critic, the baseline is the mean return of the pomo_size rollouts of each instance
             self.optimizer = torch.optim.Adam(
-            [{'params':  self.actor.parameters(), 'lr': opts.lr_model}] + 
-            [{'params':  self.critic.parameters(), 'lr': opts.lr_critic}])
+            [{'params':  self.actor.parameters(), 'lr': opts.lr_model}])
             
             self.lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(self.optimizer, opts.lr_decay, last_epoch=-1,)
 
@@ -72,7 +52,10 @@ class Reinforce:
         if opts.use_cuda and not opts.distributed:
             
             self.actor.to(opts.device)
-            if not opts.eval_only: self.critic.to(opts.device)
+        
+        # compiled encoder for inference
+        if opts.compile_actor:
+            self.actor.enable_compile(opts.compile_buckets, [size + 1] if opts.compile_prewarm else [])
                 
     
     def load(self, load_path):
@@ -84,9 +67,6 @@ class Reinforce:
         model_actor.load_state_dict({**model_actor.state_dict(), **load_data.get('actor', {})})
         
         if not self.opts.eval_only:
-            # load data for critic
-            model_critic = get_inner_model(self.critic)
-            model_critic.load_state_dict({**model_critic.state_dict(), **load_data.get('critic', {})})
             # load data for optimizer
             self.optimizer.load_state_dict(load_data['optimizer'])
             # load data for torch and cuda
@@ -102,7 +82,6 @@ class Reinforce:
         torch.save(
             {
                 'actor': get_inner_model(self.actor).state_dict(),
-                'critic': get_inner_model(self.critic).state_dict(),
                 'optimizer': self.optimizer.state_dict(),
                 'rng_state': torch.get_rng_state(),
                 'cuda_rng_state': torch.cuda.get_rng_state_all(),
@@ -114,15 +93,19 @@ class Reinforce:
     def eval(self):
         torch.set_grad_enabled(False)
         self.actor.eval()
-        if not self.opts.eval_only: self.critic.eval()
         
     def train(self):
         torch.set_grad_enabled(True)
         self.actor.train()
-        if not self.opts.eval_only: self.critic.train()
     
     def rollout(self, problem, batch, do_sample = False, show_bar = False):     # TODO NOW: output
         batch = move_to(batch, self.opts.device) # batch_size, graph_size, 2
+
+        # decode val_m rotated and/or sampled copies of every instance in one batch and keep the best
+        val_m, aug_mode = self.opts.val_m, self.opts.val_aug_mode
+        if val_m > 1:
+            orig_batch = batch
+            batch = augment_batch(batch, val_m, aug_mode)
         bs, gs, dim = batch['coordinates'].size()
 
 
@@ -138,15 +121,37 @@ class Reinforce:
 
         dy_size = problem.size - 2 * problem.static_orders
         action_his = torch.zeros_like(padded_solution, dtype=torch.bool, device=padded_solution.device)
-        for t in tqdm(range(dy_size // 2), disable = self.opts.no_progress_bar or not show_bar, desc = 'rollout', bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}'):
+        if self.opts.beam_width > 1 and not do_sample:
+            padded_solution, obj = beam_search(problem, self.actor, batch, self.opts.beam_width,
+                                               time_budget = self.opts.beam_time_budget)
+        # with a deadline, a step that would overrun it (judged by the recent model step times for this
+        # batch shape) inserts the cheapest insertion instead of calling the model
+        deadline = self.opts.deadline_ms / 1000 if self.opts.deadline_ms is not None else None
+        fallback_steps = torch.zeros(bs, dtype=torch.long, device=padded_solution.device)
+        s_time = time.time()
+        for t in tqdm(range(dy_size // 2 if self.opts.beam_width <= 1 or do_sample else 0), disable = self.opts.no_progress_bar or not show_bar, desc = 'rollout', bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}'):
             step_info = (dy_size, t)
-            # pass through model
-            exchange = self.actor(problem,
-                                  batch_feature,
-                                  padded_solution,
-                                  action_his,
-                                  step_info,
-                                  do_sample = do_sample)[0]
+            step_time = self.step_time.get((bs, gs))
+            if deadline is not None and time.time() - s_time + step_time > deadline:
+                exchange = problem.get_cheapest_insertion(batch_feature, padded_solution, action_his)
+                action_his.scatter_(1, exchange[:, :1], True)
+                action_his.scatter_(1, exchange[:, :1] + dy_size // 2, True)
+                fallback_steps += 1
+            else:
+                t_step = time.time()
+                n_compiles = getattr(self.actor.compiled_encode, 'n_compiles', 0)
+                # sampled copies draw distinct first insertions, later steps are sampled independently
+                sample_info = (val_m, t == 0 and aug_mode == 'sample') if val_m > 1 and aug_mode != 'rotate' else None
+                # pass through model
+                exchange = self.actor(problem,
+                                      batch_feature,
+                                      padded_solution,
+                                      action_his,
+                                      step_info,
+                                      do_sample = do_sample,
+                                      sample_info = sample_info)[0]
+                self.step_time.update((bs, gs), time.time() - t_step,
+                                      compiled = getattr(self.actor.compiled_encode, 'n_compiles', 0) != n_compiles)
 
             # new solution
             padded_solution, rewards, obj = problem.step(batch, padded_solution, exchange, obj, None)
@@ -154,6 +159,11 @@ class Reinforce:
 
 
 
+        if val_m > 1:
+            padded_solution, obj = select_best_copy(problem, orig_batch, padded_solution, obj, val_m)
+            batch = orig_batch
+            fallback_steps = fallback_steps.view(val_m, -1)[0]
+
         # statistic
         obj1 = problem.get_costs(batch, padded_solution, flag_finish=True)
         final_obj = obj.view(-1)
@@ -162,13 +172,7 @@ class Reinforce:
 
         bool_obj_ci = final_obj.view(-1, 1) < cheapest_ins_obj.view(-1, 1)
         bool_obj_mm = final_obj.view(-1, 1) < mm_obj.view(-1, 1)
-        count_obj_ci = torch.sum(final_obj <= cheapest_ins_obj)
-        count_obj_mm = torch.sum(final_obj <= mm_obj)
-
-        sum_diff_obj_ci = torch.sum((final_obj - cheapest_ins_obj)/cheapest_ins_obj)
-        average_diff_obj_ci = sum_diff_obj_ci / final_obj.size(0)
-        sum_diff_obj_mm = torch.sum((final_obj - mm_obj)/mm_obj)
-        average_diff_obj_mm = sum_diff_obj_mm / final_obj.size(0)
+        count_obj_ci, average_diff_obj_ci, count_obj_mm, average_diff_obj_mm = get_val_stats(final_obj, cheapest_ins_obj, mm_obj)
 
 
         out = (padded_solution, # bs, gs
@@ -178,13 +182,16 @@ class Reinforce:
                average_diff_obj_ci,  # 1
                bool_obj_mm,
                count_obj_mm,
-               average_diff_obj_mm
+               average_diff_obj_mm,
+               fallback_steps # batch_size, steps decided by the CI fallback
                )
         
         return out
     
     
     def start_inference(self, problem, val_dataset, tb_logger):
+        if self.opts.quantize:
+            quantize_actor(get_inner_model(self.actor), self.opts.quant_groups)
         if self.opts.distributed:            
             mp.spawn(validate, nprocs=self.opts.world_size, args=(problem, self, val_dataset, tb_logger, True))
         else:
@@ -192,7 +199,7 @@ class Reinforce:
             
     def start_training(self, problem, train_dataset, val_dataset, tb_logger):
         if self.opts.distributed:
-            mp.spawn(train, nprocs=self.opts.world_size, args=(problem, self, train_dataset, val_dataset, tb_logger))
+            mp.spawn(train, nprocs=self.opts.nproc_per_node, args=(problem, self, train_dataset, val_dataset, tb_logger))
         else:
             train(0, problem, self, train_dataset, val_dataset, tb_logger)
 
@@ -211,21 +218,29 @@ def train(rank, problem, agent, train_dataset, val_dataset, tb_logger):
         random.seed(opts.seed)
         
     if opts.distributed:
-        device = torch.device("cuda", rank)
-        torch.distributed.init_process_group(backend='nccl', world_size=opts.world_size, rank = rank)
-        torch.cuda.set_device(rank)
+        # mp.spawn gives the local rank on this node, the process group uses the global rank
+        local_rank = rank
+        rank = opts.node_rank * opts.nproc_per_node + local_rank
+        if opts.use_cuda:
+            device = torch.device("cuda", local_rank)
+            torch.cuda.set_device(local_rank)
+        else:
+            # CPU ranks share the cores of the node
+            device = torch.device("cpu")
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // opts.nproc_per_node))
+        opts.device = device
+        torch.distributed.init_process_group(backend=opts.dist_backend, world_size=opts.world_size, rank = rank)
         agent.actor.to(device)
-        agent.critic.to(device)
         for state in agent.optimizer.state.values():
                 for k, v in state.items():
                     if torch.is_tensor(v):
                         state[k] = v.to(device)
         
 
+        device_ids = [local_rank] if opts.use_cuda else None
         agent.actor = torch.nn.parallel.DistributedDataParallel(agent.actor,
-                                                               device_ids=[rank])
-        if not opts.eval_only: agent.critic = torch.nn.parallel.DistributedDataParallel(agent.critic,
-                                                               device_ids=[rank])
+                                                               device_ids=device_ids,
+                                                               find_unused_parameters=True)
         if not opts.no_tb and rank == 0:
             tb_logger = TbLogger(os.path.join(opts.log_dir, "{}_{}".format(opts.problem, 
                                                           opts.graph_size), opts.run_name))
@@ -246,8 +261,7 @@ def train(rank, problem, agent, train_dataset, val_dataset, tb_logger):
         if rank == 0:
             print('\n\n')
             print("|",format(f" Training epoch {epoch} ","*^60"),"|")
-            print("Training with actor lr={:.3e} critic lr={:.3e} for run {}".format(agent.optimizer.param_groups[0]['lr'], 
-                                                                                 agent.optimizer.param_groups[1]['lr'], opts.run_name) , flush=True)
+            print("Training with actor lr={:.3e} for run {}".format(agent.optimizer.param_groups[0]['lr'], opts.run_name) , flush=True)
         # prepare training data
         training_dataset = problem.make_dataset(size=opts.graph_size, num_samples=opts.epoch_size,filename=train_dataset)
         if opts.distributed:
@@ -263,7 +277,7 @@ def train(rank, problem, agent, train_dataset, val_dataset, tb_logger):
             
         # start training
         step = epoch * (opts.epoch_size // opts.batch_size)  
-        pbar = tqdm(total = (opts.K_epochs) * (opts.epoch_size // opts.batch_size) * (opts.T_train // opts.n_step) ,
+        pbar = tqdm(total = opts.epoch_size // opts.batch_size,
                     disable = opts.no_progress_bar or rank!=0, desc = 'training',
                     bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}')
         for batch_id, batch in enumerate(training_dataloader):
@@ -280,18 +294,14 @@ def train(rank, problem, agent, train_dataset, val_dataset, tb_logger):
             step += 1
         pbar.close()
         
-        # save new model after one epoch  
-        if rank == 0 and not opts.distributed: 
-            if not opts.no_saving and (( opts.checkpoint_epochs != 0 and epoch % opts.checkpoint_epochs == 0) or \
-                        epoch == opts.epoch_end - 1): agent.save(epoch)
-        elif opts.distributed and rank == 1:
+        # save new model after one epoch, only the (global) rank 0 writes checkpoints
+        if rank == 0:
             if not opts.no_saving and (( opts.checkpoint_epochs != 0 and epoch % opts.checkpoint_epochs == 0) or \
                         epoch == opts.epoch_end - 1): agent.save(epoch)
             
         
         # validate the new model   
-        if rank == 0 and not opts.distributed: validate(rank, problem, agent, val_dataset, tb_logger, _id = epoch)
-        if rank == 0 and opts.distributed: validate(rank, problem, agent, val_dataset, tb_logger, _id = epoch)
+        if rank == 0: validate(rank, problem, agent, val_dataset, tb_logger, _id = epoch)
         
         # syn
         if opts.distributed: dist.barrier()
@@ -311,119 +321,75 @@ def train_batch(
 
     # setup
     agent.train()
-    memory = Memory()
-
-    # prepare the input
-    batch = move_to_cuda(batch, rank) if opts.distributed else move_to(batch, opts.device)# batch_size, graph_size, 2
-    batch_feature = problem.input_feature_encoding(batch).cuda() if opts.distributed \
-                        else move_to(problem.input_feature_encoding(batch), opts.device)
-    batch_size = batch_feature.size(0)
-    exchange = move_to_cuda(torch.tensor([-1,-1,-1]).repeat(batch_size,1), rank) if opts.distributed \
-                        else move_to(torch.tensor([-1,-1,-1]).repeat(batch_size,1), opts.device)
-    
 
-    # print(f"rank {rank}, data from {batch['id'][0]},{batch['id'][1]} , to {batch['id'][-2]},{batch['id'][-1]}")
+    # pomo_size sampled rollouts of every instance in one batch, copy c of instance i sits at c * bs + i
+    pomo_size = opts.pomo_size
+    batch = move_to(batch, opts.device)# batch_size, graph_size, 2
+    batch_size = batch['coordinates'].size(0)
+    if pomo_size > 1:
+        batch = augment_batch(batch, pomo_size, 'sample')
+    batch_feature = problem.input_feature_encoding(batch)
 
     # initial solution of the static orders
 
-    solution = move_to_cuda(problem.get_static_solutions(batch),rank) if opts.distributed \
-                        else move_to(problem.get_static_solutions(batch), opts.device)
+    solution = problem.get_static_solutions(batch)
     obj = problem.get_costs(batch, solution, flag_finish = False)
     padded_solution = pad_solution(solution, batch_feature.size(1))
 
     # params for training
-    gamma = opts.gamma
-    n_step = opts.n_step
-    T = opts.T_train
-    K_epochs = opts.K_epochs
-    eps_clip = opts.eps_clip
     epsilon = opts.epsilon  # e-greedy for decoder sampling action
     epsilon_decay = opts.epsilon_decay
     epsilon_info = (epsilon, epsilon_decay, epoch)
 
     initial_cost = obj
-    
-    # sample trajectory
-
-    memory.actions.append(exchange)
-
-
-    # for first step
-    entropy = []
-    bl_val_detached = []
-
 
     dy_size = problem.size - 2 * problem.static_orders
-    t = 0
+    t_time = dy_size // 2
+
+    # sample trajectories
     log_likelihood = 0
     R = 0
     action_his = torch.zeros_like(padded_solution, dtype=torch.bool, device=padded_solution.device)
-    while t < (dy_size // 2):
-
-        memory.states.append(padded_solution)
-
+    for t in range(t_time):
 
         # get model output
         step_info = (dy_size, t)
-        exchange, log_lh, _to_critic, entro_p, CI_action = agent.actor(problem,
+        exchange, log_lh, _to_critic, CI_action = agent.actor(problem,
                                                              batch_feature,
                                                              padded_solution,
                                                              action_his,
                                                              step_info,
                                                              epsilon_info=epsilon_info,
-                                                             do_sample = True,
-                                                             require_entropy = True,# take same action
-                                                             to_critic = True)
+                                                             do_sample = True)
 
-        memory.actions.append(exchange)
-        memory.logprobs.append(log_lh)
         log_likelihood += log_lh
 
-        memory.obj.append(obj.unsqueeze(-1))
-
-
-        entropy.append(entro_p.detach().cpu())
-
-
         # state transient
         padded_solution, rewards, obj = problem.step(batch, padded_solution, exchange, obj, CI_action)
-        memory.rewards.append(rewards)
-        # memory.mask_true = memory.mask_true + info['swaped']
-
-        # store info
-        R += rewards
-
-        # next step
-        t = t + 1
-
+        R += rewards.view(-1)
 
+    # shared baseline: the mean return of the rollouts of the same instance (none with a single rollout)
+    baseline = R.view(pomo_size, batch_size).mean(0).repeat(pomo_size) if pomo_size > 1 else torch.zeros_like(R)
+    advantage = R - baseline
 
     # begin update        =======================
 
-
-
     # calculate loss
-    loss = (-R * log_likelihood).mean()
+    loss = (-advantage.detach() * log_likelihood.view(-1)).mean()
 
     # update gradient step
     agent.optimizer.zero_grad()
     loss.backward()
 
     # Clip gradient norm and get (clipped) gradient norms for logging
-    current_step = int(1)
-
+    grad_norms = clip_grad_norms(agent.optimizer.param_groups, opts.max_grad_norm)
 
     # perform gradient descent
     agent.optimizer.step()
 
     # Logging to tensorboard
     if(not opts.no_tb) and rank == 0:
-        if (current_step + 1) % int(opts.log_step) == 0:
-            log_to_tb_train(tb_logger, agent, R, log_likelihood, initial_cost, current_step + 1)
+        if step % int(opts.log_step) == 0:
+            log_to_tb_train_reinforce(tb_logger, agent, R, baseline, obj, grad_norms, loss, log_likelihood, initial_cost, step)
 
     if rank == 0: pbar.update(1)
-
-
-    # end update
-    memory.clear_memory()
-
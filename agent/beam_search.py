@@ -0,0 +1,72 @@
+import time
+import torch
+
+from utils.utils import pad_solution
+
+
+def beam_search(problem, actor, batch, beam_width, time_budget = None, n_removal = None, n_reinsertion = None):
+    '''
+    keep the beam_width cheapest partial routes of every instance over the dy_size // 2 insertion steps;
+    every beam proposes the top candidates of the removal and reinsertion heads and all bs * beam_width
+    states go through the actor together, the candidates are pruned by the exact cost of the resulting routes.
+    once time_budget (seconds) is spent, only the best beam of every instance is kept and decoded greedily.
+    returns the best padded solution (bs, gs) and its cost (bs,)
+    '''
+    n_removal = beam_width if n_removal is None else n_removal
+    n_reinsertion = beam_width if n_reinsertion is None else n_reinsertion
+    s_time = time.time()
+
+    batch_feature = problem.input_feature_encoding(batch)
+    bs, gs, _ = batch_feature.size()
+    dy_size = problem.size - 2 * problem.static_orders
+
+    solutions = problem.get_static_solutions(batch).to(batch_feature.device).long()
+    obj = problem.get_costs(batch, solutions)
+    padded_solution = pad_solution(solutions, gs)
+
+    # beam b of instance i sits at i * width + b, only the first beam is alive before the first step
+    width = 1
+    rec = padded_solution
+    action_his = torch.zeros_like(rec, dtype = torch.bool)
+    cost = obj.view(bs, 1)
+    beam_batch = batch
+
+    for t in range(dy_size // 2):
+        expired = time_budget is not None and time.time() - s_time > time_budget
+        if expired and width > 1:
+            best = cost.min(-1)[1]
+            index = torch.arange(bs, device = rec.device) * width + best
+            rec, action_his, cost = rec[index], action_his[index], cost.gather(1, best.view(-1, 1))
+            width = 1
+            beam_batch = batch
+        step_info = (dy_size, t)
+        step_width, step_removal, step_reinsertion = (1, 1, 1) if expired else (beam_width, n_removal, n_reinsertion)
+
+        # propose candidates for every alive beam at once and cost them exactly
+        candidates, _, valid = actor.propose(problem, batch_feature.repeat_interleave(width, 0), rec, action_his,
+                                             step_info, step_removal, step_reinsertion)
+        n_cand = candidates.size(1)
+        new_cost, feasible = problem.score_candidates(beam_batch, rec, candidates)
+        new_cost = torch.where(valid & feasible & torch.isfinite(cost.view(-1, 1)), new_cost,
+                               torch.full_like(new_cost, float('inf')))
+
+        # prune to the cheapest beams of every instance
+        new_width = min(step_width, width * n_cand)
+        flat_cost = new_cost.view(bs, width * n_cand)
+        cost, top = flat_cost.topk(new_width, dim = -1, largest = False)
+        parent = torch.arange(bs, device = rec.device).view(-1, 1) * width + top // n_cand
+        chosen = candidates.view(bs, width * n_cand, 3).gather(1, top.unsqueeze(-1).expand(-1, -1, 3)).view(-1, 3)
+
+        parent = parent.view(-1)
+        rec = problem.insert_star(rec[parent], chosen[:, :1], chosen[:, 1:2], chosen[:, 2:])
+        action_his = action_his[parent].clone()
+        action_his.scatter_(1, chosen[:, :1], True)
+        action_his.scatter_(1, chosen[:, :1] + dy_size // 2, True)
+        if new_width != width:
+            beam_batch = {key: batch[key].repeat_interleave(new_width, 0) for key in ('coordinates', 'dynamic_loc')}
+        width = new_width
+
+    best = cost.min(-1)[1]
+    index = torch.arange(bs, device = rec.device) * width + best
+    padded_solution = rec[index]
+    return padded_solution, problem.get_costs(batch, padded_solution)
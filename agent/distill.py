@@ -0,0 +1,192 @@
+import os
+import json
+import warnings
+import random
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from torch.utils.data import DataLoader
+
+from nets.actor_network import Actor
+from utils.utils import clip_grad_norms, torch_load_cpu, move_to, pad_solution
+from utils.logger import log_to_tb_distill, log_to_tb_metrics
+from agent.utils import evaluate_agents, with_actor
+
+
+def load_teacher(load_path, problem, opts):
+    # the teacher architecture is read from its state dict, the student one comes from opts
+    state_dict = torch_load_cpu(load_path)['actor']
+    prefix = 'encoder.0.MHA_sublayer.Norm.normalizer.'
+    normalization = 'batch' if prefix + 'running_mean' in state_dict else \
+                    'instance' if prefix + 'weight' in state_dict else 'layer'
+    ff_weight = state_dict.get('encoder.0.FFandNorm_sublayer.FF.0.weight')
+    teacher = Actor(
+        problem_name = problem.NAME,
+        embedding_dim = state_dict['embedder.embedder.weight'].size(0),
+        hidden_dim = ff_weight.size(0) if ff_weight is not None else 0,
+        n_heads_actor = state_dict['encoder_l2n.0.MHA_sublayer.MHA.W_query'].size(0),
+        n_layers = len({key.split('.')[1] for key in state_dict if key.startswith('encoder.')}),
+        normalization = normalization,
+        v_range = opts.v_range,
+        seq_length = problem.size + 1,
+        precision = opts.precision
+    )
+    teacher.load_state_dict(state_dict)
+    print(' [*] Loading teacher from {}'.format(load_path))
+    return teacher.to(opts.device).eval()
+
+
+def make_synthetic_batch(problem, batch_size):
+    # uniform instances with the depot at the centre as in the datasets,
+    # the static orders are served one after another (pickup, delivery) in a random order
+    n_static = problem.static_orders
+    dy_size = problem.size - 2 * n_static
+    coordinates = torch.rand(batch_size, 2 * n_static + 1, 2)
+    coordinates[:, 0] = 0.5
+    sol_static = torch.zeros(batch_size, 2 * n_static + 1, dtype = torch.long)
+    arange = torch.arange(batch_size)
+    pre = torch.zeros(batch_size, dtype = torch.long)
+    for pickup in (torch.rand(batch_size, n_static).argsort(-1) + 1).t():
+        sol_static[arange, pre] = pickup
+        sol_static[arange, pickup] = pickup + n_static
+        pre = pickup + n_static
+    return {'coordinates': coordinates, 'sol_static': sol_static, 'dynamic_loc': torch.rand(batch_size, dy_size, 2)}
+
+
+def get_tables(actor, problem, x_in, solution, action_his, step_info, action_removal = None):
+    '''
+    logits of both heads of the actor at one insertion step, masked entries at -1e20
+    the reinsertion table is computed for action_removal (the argmax order of the actor when None)
+    returns the removal table (bs, gs), the reinsertion table (bs, gs * gs), their masks, the order and the new action_his
+    '''
+    dy_size, _ = step_info
+    bs, gs = solution.size()
+    index_for_freqs, visited_time = actor.embedder.get_visited_time(solution, step_info)
+    visited_order_map = problem.get_visited_order_map(visited_time, step_info)
+    with actor.autocast(x_in):
+        h_em = actor.compiled_encode(x_in, index_for_freqs)
+        removal_table = actor.decoder.get_removal_table(h_em, solution, dy_size)
+        if action_removal is None:
+            action_removal = removal_table.max(-1)[1].unsqueeze(1)
+        action_his = action_his.clone()
+        action_his.scatter_(1, action_removal, True)
+        action_his.scatter_(1, action_removal + dy_size // 2, True)
+        mask_table = problem.get_swap_mask(action_removal, visited_order_map, step_info, action_his)
+        pos_pickup = action_removal.view(-1)
+        reinsertion_table = actor.decoder.get_reinsertion_table(h_em, pos_pickup, pos_pickup + dy_size // 2,
+                                                                solution, mask_table).reshape(bs, -1)
+    removal_mask = problem.get_removal_mask(solution)
+    return removal_table, reinsertion_table, removal_mask, mask_table.view(bs, -1), action_removal, action_his
+
+
+def masked_kl(teacher_logits, student_logits, mask, temperature = 1.):
+    # KL(teacher || student) over the unmasked entries, averaged over the batch
+    log_p_teacher = F.log_softmax(teacher_logits.masked_fill(mask, -1e20) / temperature, dim = -1)
+    log_p_student = F.log_softmax(student_logits.masked_fill(mask, -1e20) / temperature, dim = -1)
+    kl = torch.where(mask, torch.zeros_like(log_p_teacher), log_p_teacher.exp() * (log_p_teacher - log_p_student))
+    return kl.sum(-1).mean() * temperature ** 2
+
+
+def distill_batch(problem, agent, teacher, batch, opts):
+    # follow the greedy insertions of the teacher and fit the student to both of its distributions at every step;
+    # the states do not depend on the student, so every step is backpropagated on its own
+    batch = move_to(batch, opts.device)
+    x_in = problem.input_feature_encoding(batch)
+    solution = pad_solution(move_to(problem.get_static_solutions(batch), opts.device).long(), x_in.size(1))
+    action_his = torch.zeros_like(solution, dtype = torch.bool)
+    dy_size = problem.size - 2 * problem.static_orders
+    n_steps = dy_size // 2
+
+    agent.optimizer.zero_grad()
+    kl_removal, kl_reinsertion = 0., 0.
+    for t in range(n_steps):
+        step_info = (dy_size, t)
+        with torch.no_grad():
+            removal_t, reinsertion_t, removal_mask, mask_table, action_removal, new_action_his = \
+                get_tables(teacher, problem, x_in, solution, action_his, step_info)
+        removal_s, reinsertion_s = get_tables(agent.actor, problem, x_in, solution, action_his, step_info,
+                                              action_removal)[:2]
+        loss_removal = masked_kl(removal_t, removal_s, removal_mask, opts.distill_temperature)
+        loss_reinsertion = masked_kl(reinsertion_t, reinsertion_s, mask_table, opts.distill_temperature)
+        ((loss_removal + loss_reinsertion) / n_steps).backward()
+        kl_removal += loss_removal.item() / n_steps
+        kl_reinsertion += loss_reinsertion.item() / n_steps
+
+        # the teacher's greedy insertion
+        pair_index = reinsertion_t.masked_fill(mask_table, -1e20).max(-1)[1].view(-1, 1)
+        gs = solution.size(1)
+        solution = problem.insert_star(solution, action_removal, pair_index // gs, pair_index % gs)
+        action_his = new_action_his
+
+    grad_norms = clip_grad_norms(agent.optimizer.param_groups[:1], opts.max_grad_norm)
+    agent.optimizer.step()
+    return kl_removal, kl_reinsertion, grad_norms
+
+
+def report_tradeoff(teacher_summary, student_summary):
+    print('-' * 60)
+    for name, key in (('Gap to cheapest insertion', 'gap_ci'), ('Gap to math model', 'gap_mm')):
+        print('{}:'.format(name).center(35), 'teacher {:.6f} student {:.6f} change {:+.6f}'.format(
+            teacher_summary[key]['mean'], student_summary[key]['mean'],
+            student_summary[key]['mean'] - teacher_summary[key]['mean']))
+    print('Batch latency (s):'.center(35), 'teacher {:.6f} student {:.6f} speedup {:.3f}x'.format(
+        teacher_summary['batch_latency']['mean'], student_summary['batch_latency']['mean'],
+        teacher_summary['batch_latency']['mean'] / student_summary['batch_latency']['mean']))
+    print('-' * 60, '\n')
+
+
+def distill(problem, agent, train_dataset, val_dataset, tb_logger):
+    # train the agent's (smaller) actor on the removal and reinsertion distributions of a trained teacher actor
+    opts = agent.opts
+    warnings.filterwarnings("ignore")
+    if opts.resume is None:
+        torch.manual_seed(opts.seed)
+        random.seed(opts.seed)
+    assert not opts.distributed, 'distillation runs in a single process'
+
+    teacher = load_teacher(opts.distill_teacher, problem, opts)
+    teacher_agent = with_actor(agent, teacher)
+    val_dataloader = DataLoader(problem.make_dataset(filename = val_dataset, size = opts.graph_size,
+                                                     num_samples = opts.val_size, flag_val = True),
+                                batch_size = opts.val_batch_size, shuffle = False, num_workers = 0)
+    for state in agent.optimizer.state.values():
+        for k, v in state.items():
+            if torch.is_tensor(v):
+                state[k] = v.to(opts.device)
+
+    for epoch in range(opts.epoch_start, opts.epoch_end):
+        agent.lr_scheduler.step(epoch)
+        print('\n\n')
+        print("|", format(f" Distillation epoch {epoch} ", "*^60"), "|")
+        print("Distilling with actor lr={:.3e} for run {}".format(agent.optimizer.param_groups[0]['lr'], opts.run_name), flush = True)
+
+        if opts.distill_synthetic:
+            batches = [make_synthetic_batch(problem, opts.batch_size) for _ in range(opts.epoch_size // opts.batch_size)]
+        else:
+            batches = DataLoader(problem.make_dataset(size = opts.graph_size, num_samples = opts.epoch_size, filename = train_dataset),
+                                 batch_size = opts.batch_size, shuffle = False, num_workers = 0)
+
+        agent.train()
+        step = epoch * (opts.epoch_size // opts.batch_size)
+        for batch in tqdm(batches, disable = opts.no_progress_bar, desc = 'distillation',
+                          bar_format = '{l_bar}{bar:20}{r_bar}{bar:-20b}'):
+            kl_removal, kl_reinsertion, grad_norms = distill_batch(problem, agent, teacher, batch, opts)
+            if tb_logger is not None and step % int(opts.log_step) == 0:
+                log_to_tb_distill(tb_logger, agent, kl_removal, kl_reinsertion, grad_norms, step)
+            step += 1
+        print('KL removal {:.6f} reinsertion {:.6f}'.format(kl_removal, kl_reinsertion))
+
+        if not opts.no_saving and ((opts.checkpoint_epochs != 0 and epoch % opts.checkpoint_epochs == 0) or
+                                   epoch == opts.epoch_end - 1):
+            agent.save(epoch)
+
+        # speed / gap trade-off of the student against the teacher
+        teacher_summary, student_summary = evaluate_agents([teacher_agent, agent], problem, val_dataloader)
+        report_tradeoff(teacher_summary, student_summary)
+        if tb_logger is not None:
+            log_to_tb_metrics(tb_logger, student_summary, epoch)
+        metrics_path = opts.metrics_path if opts.metrics_path is not None else \
+                            (os.path.join(opts.save_dir, 'distill_metrics.json') if not opts.no_saving else None)
+        if metrics_path is not None:
+            with open(metrics_path, 'w') as f:
+                json.dump({'epoch': epoch, 'teacher': teacher_summary, 'student': student_summary}, f, indent = True)
@@ -0,0 +1,207 @@
+import hashlib
+import threading
+from collections import OrderedDict
+import torch
+
+from options import get_options
+from nets.actor_network import Actor
+from nets.quantization import quantize_actor
+from problems.problem_pdtsp import PDTSP
+from utils.utils import torch_load_cpu, get_inner_model, pad_solution
+
+
+class InsertionCache:
+    # LRU cache of insertion results keyed on a hash of the quantised coordinates, the route and the new orders
+    # instances whose coordinates agree up to `decimals` digits share an entry (and its cost)
+    def __init__(self, max_size = 1024, decimals = 4):
+        self.max_size = max_size
+        self.scale = 10 ** decimals
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, coordinates, route, dynamic_loc):
+        digest = hashlib.blake2b(digest_size = 16)
+        for x in (coordinates, dynamic_loc):
+            digest.update(torch.round(x.detach().cpu() * self.scale).to(torch.int64).numpy().tobytes())
+            digest.update(b'|')
+        digest.update(route.detach().cpu().to(torch.int64).numpy().tobytes())
+        return digest.digest()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {'size': len(self.entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.}
+
+
+class Inserter:
+    # in-process insertion API for online dispatch: the actor is loaded once and reused for every call
+    #
+    # solve reuses one set of input buffers per shape, so concurrent insert() calls from several threads
+    # are serialised by a lock (the scheduler of agent/server.py calls from a single thread and never waits on it).
+    #
+    # node indexing follows the datasets: 0 is the depot, 1..n_static the static pickups,
+    # n_static+1..2*n_static their deliveries, then the n_new new pickups followed by their n_new deliveries.
+    # coordinates are expected in the normalised [0, 1] scale used for training (the datasets divide by 100).
+    def __init__(self, load_path = None, opts = None):
+
+        if opts is None:
+            opts = get_options(['--eval_only', '--no_saving', '--no_tb', '--no_progress_bar'])
+        self.opts = opts
+        self.device = torch.device("cuda" if opts.use_cuda else "cpu")
+
+        self.actor = Actor(
+            problem_name = opts.problem,
+            embedding_dim = opts.embedding_dim,
+            hidden_dim = opts.hidden_dim,
+            n_heads_actor = opts.actor_head_num,
+            n_layers = opts.n_encode_layers,
+            normalization = opts.normalization,
+            v_range = opts.v_range,
+            seq_length = opts.graph_size + 1,
+            rescore_k = opts.rescore_k,
+            precision = opts.precision
+        )
+        if load_path is not None:
+            load_data = torch_load_cpu(load_path)
+            model_actor = get_inner_model(self.actor)
+            model_actor.load_state_dict({**model_actor.state_dict(), **load_data.get('actor', {})})
+        self.actor.to(self.device)
+        self.actor.eval()
+        if opts.quantize:
+            quantize_actor(self.actor, opts.quant_groups)
+        if opts.compile_actor:
+            self.actor.enable_compile(opts.compile_buckets, [opts.graph_size + 1] if opts.compile_prewarm else [])
+
+        # one PDTSP per (number of static orders, number of new orders) and one set of input buffers per shape
+        self.problems = {}
+        self.buffers = {}
+        self.lock = threading.Lock()
+        self.cache = InsertionCache(opts.cache_size, opts.cache_decimals) if opts.cache_size > 0 else None
+
+    def get_problem(self, n_static, n_new):
+        key = (n_static, n_new)
+        if key not in self.problems:
+            self.problems[key] = PDTSP(p_size = 2 * (n_static + n_new), sta_orders = n_static,
+                                       with_assert = self.opts.use_assert)
+        return self.problems[key]
+
+    def get_buffers(self, bs, gs):
+        key = (bs, gs)
+        if key not in self.buffers:
+            self.buffers[key] = (torch.zeros(bs, gs, 2, device = self.device),
+                                 torch.zeros(bs, gs, dtype = torch.long, device = self.device),
+                                 torch.zeros(bs, gs, dtype = torch.bool, device = self.device))
+        return self.buffers[key]
+
+    @torch.inference_mode()
+    def insert(self, coordinates, route, dynamic_loc):
+        '''
+        coordinates: (n_c, 2) or (bs, n_c, 2), depot and the static orders, n_c = 1 + 2 * n_static
+        route: (n_c,) or (bs, n_c), successor array of the current route over the static nodes
+        dynamic_loc: (2 * n_new, 2) or (bs, 2 * n_new, 2), pickups of the new orders followed by their deliveries
+        returns the insertion actions (bs, n_new, 3) as (pickup node, node the pickup follows,
+        node the delivery follows) in insertion order, the new successor array (bs, gs) and its cost (bs,)
+        '''
+        coordinates, route, dynamic_loc = torch.as_tensor(coordinates), torch.as_tensor(route), torch.as_tensor(dynamic_loc)
+        unbatched = coordinates.dim() == 2
+        if unbatched:
+            coordinates, route, dynamic_loc = coordinates.unsqueeze(0), route.unsqueeze(0), dynamic_loc.unsqueeze(0)
+
+        bs, n_c, _ = coordinates.size()
+        dy_size = dynamic_loc.size(1)
+        assert n_c % 2 == 1 and dy_size % 2 == 0 and dy_size > 0 and route.size(1) == n_c, 'The input (route or orders) is wrong...'
+
+        if self.cache is None:
+            actions, solution, obj = self.solve(coordinates, route, dynamic_loc)
+        else:
+            # cache hits skip the actor, only the missed instances are solved (as one batch)
+            keys = [self.cache.key(coordinates[i], route[i], dynamic_loc[i]) for i in range(bs)]
+            results = [self.cache.get(key) for key in keys]
+            miss = [i for i, result in enumerate(results) if result is None]
+            if miss:
+                solved = self.solve(coordinates[miss], route[miss], dynamic_loc[miss])
+                for j, i in enumerate(miss):
+                    results[i] = tuple(x[j].clone() for x in solved)
+                    self.cache.put(keys[i], results[i])
+            actions, solution, obj = [torch.stack(x) for x in zip(*results)]
+
+        if unbatched:
+            return actions[0], solution[0], obj[0]
+        return actions, solution, obj
+
+    def solve(self, coordinates, route, dynamic_loc):
+        # insert the new orders one by one with the greedy actor, as in PPO.rollout; one call at a time
+        with self.lock:
+            bs, n_c, _ = coordinates.size()
+            dy_size = dynamic_loc.size(1)
+            n_static, n_new = n_c // 2, dy_size // 2
+            gs = n_c + dy_size
+            problem = self.get_problem(n_static, n_new)
+
+            # refill the reused buffers in place
+            x_in, solution, action_his = self.get_buffers(bs, gs)
+            x_in[:, :n_c].copy_(coordinates)
+            x_in[:, n_c:].copy_(dynamic_loc)
+            solution.zero_()
+            solution[:, :n_c].copy_(route)
+            action_his.zero_()
+            batch = {'coordinates': x_in[:, :n_c], 'dynamic_loc': x_in[:, n_c:]}
+
+            obj = problem.get_costs(batch, solution[:, :n_c])
+            actions = []
+            for t in range(n_new):
+                exchange = self.actor(problem,
+                                      x_in,
+                                      solution,
+                                      action_his,
+                                      (dy_size, t),
+                                      do_sample = False)[0]
+                solution, _, obj = problem.step(batch, solution, exchange, obj, None)
+                actions.append(exchange)
+
+            if problem.do_assert:
+                problem.check_feasibility(solution)
+
+            return torch.stack(actions, 1), solution, obj
+
+    @torch.inference_mode()
+    def score(self, coordinates, route, dynamic_loc, candidates):
+        '''
+        what-if scoring of k candidate insertions (selected, first, second) per instance
+        route: successor array over the static nodes or over all nodes (un-inserted orders padded with 0)
+        candidates: (k, 3) or (bs, k, 3); returns the exact costs (inf if infeasible) and the feasibility
+        '''
+        coordinates, route, dynamic_loc = torch.as_tensor(coordinates), torch.as_tensor(route), torch.as_tensor(dynamic_loc)
+        candidates = torch.as_tensor(candidates)
+        unbatched = coordinates.dim() == 2
+        if unbatched:
+            coordinates, route, dynamic_loc, candidates = \
+                coordinates.unsqueeze(0), route.unsqueeze(0), dynamic_loc.unsqueeze(0), candidates.unsqueeze(0)
+        n_c, dy_size = coordinates.size(1), dynamic_loc.size(1)
+        problem = self.get_problem(n_c // 2, dy_size // 2)
+        batch = {'coordinates': coordinates.to(self.device), 'dynamic_loc': dynamic_loc.to(self.device)}
+        rec = pad_solution(route.to(self.device).long(), n_c + dy_size)
+        costs, feasible = problem.score_candidates(batch, rec, candidates.to(self.device))
+        if unbatched:
+            return costs[0], feasible[0]
+        return costs, feasible
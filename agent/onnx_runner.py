@@ -0,0 +1,78 @@
+import time
+import torch
+import onnxruntime as ort
+
+from nets.graph_layers import EmbeddingNet
+from nets.onnx_export import get_onnx_paths
+from utils.utils import pad_solution
+
+
+class OnnxInserter:
+    # greedy insertion loop of PPO.rollout around the graphs written by nets/onnx_export.py:
+    # the actor runs in onnxruntime, the route state (visited times, masks, insertions) is kept by PDTSP
+    def __init__(self, path, providers = None, intra_op_threads = 0):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        providers = providers or ['CPUExecutionProvider']
+        encoder_path, reinsertion_path = get_onnx_paths(path)
+        self.encoder = ort.InferenceSession(encoder_path, options, providers = providers)
+        self.reinsertion = ort.InferenceSession(reinsertion_path, options, providers = providers)
+
+    def step(self, problem, x_in, solution, action_his, step_info):
+        # one greedy insertion, returns the action (bs, 3) as in Actor.forward(do_sample = False)
+        dy_size, dy_t = step_info
+        bs, gs = solution.size()
+        index, visited_time = EmbeddingNet.get_visited_time(solution, step_info)
+        h_em, removal_logits = self.encoder.run(None, {'x_in': x_in.numpy(),
+                                                       'index': index.numpy(),
+                                                       'removal_mask': problem.get_removal_mask(solution).numpy()})
+        action_removal = torch.from_numpy(removal_logits.argmax(-1)).view(bs, 1)
+
+        action_his.scatter_(1, action_removal, True)
+        action_his.scatter_(1, action_removal + dy_size // 2, True)
+        visited_order_map = problem.get_visited_order_map(visited_time, step_info)
+        mask_table = problem.get_swap_mask(action_removal, visited_order_map, step_info, action_his)
+        pos_pickup = action_removal.view(-1)
+        reinsertion_logits = self.reinsertion.run(None, {'h_em': h_em,
+                                                         'pos_pickup': pos_pickup.numpy(),
+                                                         'pos_delivery': (pos_pickup + dy_size // 2).numpy(),
+                                                         'rec': solution.numpy(),
+                                                         'mask_table': mask_table.numpy()})[0]
+        pair_index = torch.from_numpy(reinsertion_logits.argmax(-1)).view(bs, 1)
+        return torch.cat((action_removal, pair_index // gs, pair_index % gs), -1)
+
+    @torch.no_grad()
+    def rollout(self, problem, batch):
+        # returns the final routes (bs, gs), their costs (bs,) and the actions (bs, dy_size // 2, 3) in insertion order
+        x_in = problem.input_feature_encoding(batch).float().contiguous()
+        solutions = problem.get_static_solutions(batch).long()
+        obj = problem.get_costs(batch, solutions)
+        padded_solution = pad_solution(solutions, x_in.size(1))
+        action_his = torch.zeros_like(padded_solution, dtype = torch.bool)
+
+        dy_size = problem.size - 2 * problem.static_orders
+        actions = []
+        for t in range(dy_size // 2):
+            exchange = self.step(problem, x_in, padded_solution, action_his, (dy_size, t))
+            padded_solution, _, obj = problem.step(batch, padded_solution, exchange, obj, None)
+            actions.append(exchange)
+        return padded_solution, obj, torch.stack(actions, 1)
+
+
+@torch.no_grad()
+def compare_with_rollout(agent, problem, runner, dataloader):
+    # run PPO.rollout and the onnx runner on the same batches, report agreement of the routes and costs
+    agent.eval()
+    n_instances, n_same, max_diff, t_torch, t_onnx = 0, 0, 0., 0., 0.
+    for batch in dataloader:
+        s_time = time.time()
+        solution, obj = agent.rollout(problem, batch)[:2]
+        t_torch += time.time() - s_time
+        s_time = time.time()
+        onnx_solution, onnx_obj, _ = runner.rollout(problem, batch)
+        t_onnx += time.time() - s_time
+        n_instances += solution.size(0)
+        n_same += (solution.cpu() == onnx_solution).all(-1).sum().item()
+        max_diff = max(max_diff, (obj.cpu().view(-1) - onnx_obj.view(-1)).abs().max().item())
+    return {'instances': n_instances, 'same_routes': n_same, 'max_obj_diff': max_diff,
+            'torch_time': t_torch, 'onnx_time': t_onnx}
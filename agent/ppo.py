@@ -1,4 +1,6 @@
 import os
+import time
+import copy
 from tqdm import tqdm
 import warnings
 import torch
@@ -11,26 +13,11 @@ import random
 from utils.utils import clip_grad_norms, rotate_tensor
 from nets.actor_network import Actor
 from nets.critic_network import Critic
-from utils.utils import torch_load_cpu, get_inner_model, move_to, move_to_cuda, pad_solution
+from nets.quantization import quantize_actor
+from utils.utils import torch_load_cpu, get_inner_model, move_to, pad_solution
 from utils.logger import log_to_tb_train
-from agent.utils import validate
-
-class Memory:
-    def __init__(self):
-        self.actions = []
-        self.states = []
-        self.logprobs = []
-        self.rewards = []  
-        self.obj = []
-
-        
-    def clear_memory(self):
-        del self.actions[:]
-        del self.states[:]
-        del self.logprobs[:]
-        del self.rewards[:]
-        del self.obj[:]
-
+from agent.beam_search import beam_search
+from agent.utils import validate, get_val_stats, augment_batch, select_best_copy, get_action_his, RolloutBuffer, ReplayStore, StepTimeEstimate
 
 class PPO:
     def __init__(self, problem_name, size, opts):
@@ -38,6 +25,9 @@ class PPO:
         # figure out the options
         self.opts = opts
         
+        # model step time per batch shape, for the deadline-aware rollout
+        self.step_time = StepTimeEstimate()
+        
         # figure out the actor
         self.actor = Actor(
             problem_name = problem_name,
@@ -47,7 +37,10 @@ class PPO:
             n_layers = opts.n_encode_layers,
             normalization = opts.normalization,
             v_range = opts.v_range,
-            seq_length = size + 1
+            seq_length = size + 1,
+            rescore_k = opts.rescore_k,
+            precision = opts.precision,
+            checkpoint_activations = opts.checkpoint_activations
         )
         
         if not opts.eval_only:
@@ -59,7 +52,8 @@ class PPO:
                     hidden_dim = opts.hidden_dim,
                     n_heads = opts.critic_head_num,
                     n_layers = opts.n_encode_layers,
-                    normalization = opts.normalization
+                    normalization = opts.normalization,
+                    precision = opts.precision
                 )
         
             # figure out the optimizer
@@ -69,11 +63,18 @@ class PPO:
             
             self.lr_scheduler = torch.optim.lr_scheduler.ExponentialLR(self.optimizer, opts.lr_decay, last_epoch=-1,)
 
+        # recent trajectories reused by the PPO update
+        self.replay = ReplayStore(opts.replay_size, opts.replay_evict) if not opts.eval_only and opts.replay_size > 0 else None
+
         print(f'Distributed: {opts.distributed}')
         if opts.use_cuda and not opts.distributed:
             
             self.actor.to(opts.device)
             if not opts.eval_only: self.critic.to(opts.device)
+        
+        # compiled encoder for inference
+        if opts.compile_actor:
+            self.actor.enable_compile(opts.compile_buckets, [size + 1] if opts.compile_prewarm else [])
                 
     
     def load(self, load_path):
@@ -124,6 +125,12 @@ class PPO:
     
     def rollout(self, problem, batch, do_sample = False, show_bar = False):     # TODO NOW: output
         batch = move_to(batch, self.opts.device) # batch_size, graph_size, 2
+
+        # decode val_m rotated and/or sampled copies of every instance in one batch and keep the best
+        val_m, aug_mode = self.opts.val_m, self.opts.val_aug_mode
+        if val_m > 1:
+            orig_batch = batch
+            batch = augment_batch(batch, val_m, aug_mode)
         bs, gs, dim = batch['coordinates'].size()
 
 
@@ -139,25 +146,47 @@ class PPO:
 
         dy_size = problem.size - 2 * problem.static_orders
         action_his = torch.zeros_like(padded_solution, dtype=torch.bool, device=padded_solution.device)
-        for t in tqdm(range(dy_size // 2), disable = self.opts.no_progress_bar or not show_bar, desc = 'rollout', bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}'):
+        if self.opts.beam_width > 1 and not do_sample:
+            padded_solution, obj = beam_search(problem, self.actor, batch, self.opts.beam_width,
+                                               time_budget = self.opts.beam_time_budget)
+        # with a deadline, a step that would overrun it (judged by the recent model step times for this
+        # batch shape) inserts the cheapest insertion instead of calling the model
+        deadline = self.opts.deadline_ms / 1000 if self.opts.deadline_ms is not None else None
+        fallback_steps = torch.zeros(bs, dtype=torch.long, device=padded_solution.device)
+        s_time = time.time()
+        for t in tqdm(range(dy_size // 2 if self.opts.beam_width <= 1 or do_sample else 0), disable = self.opts.no_progress_bar or not show_bar, desc = 'rollout', bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}'):
             step_info = (dy_size, t)
-            # pass through model
-            exchange = self.actor(problem,
-                                  batch_feature,
-                                  padded_solution,
-                                  action_his,
-                                  step_info,
-                                  do_sample = do_sample)[0]
+            step_time = self.step_time.get((bs, gs))
+            if deadline is not None and time.time() - s_time + step_time > deadline:
+                exchange = problem.get_cheapest_insertion(batch_feature, padded_solution, action_his)
+                action_his.scatter_(1, exchange[:, :1], True)
+                action_his.scatter_(1, exchange[:, :1] + dy_size // 2, True)
+                fallback_steps += 1
+            else:
+                t_step = time.time()
+                n_compiles = getattr(self.actor.compiled_encode, 'n_compiles', 0)
+                # sampled copies draw distinct first insertions, later steps are sampled independently
+                sample_info = (val_m, t == 0 and aug_mode == 'sample') if val_m > 1 and aug_mode != 'rotate' else None
+                # pass through model
+                exchange = self.actor(problem,
+                                      batch_feature,
+                                      padded_solution,
+                                      action_his,
+                                      step_info,
+                                      do_sample = do_sample,
+                                      sample_info = sample_info)[0]
+                self.step_time.update((bs, gs), time.time() - t_step,
+                                      compiled = getattr(self.actor.compiled_encode, 'n_compiles', 0) != n_compiles)
 
             # new solution
             padded_solution, rewards, obj = problem.step(batch, padded_solution, exchange, obj, None)
 
 
 
-        # # output the solution
-        # import pickle
-        # with open('sol.pkl', 'wb') as output_file:
-        #     pickle.dump(padded_solution, output_file)
+        if val_m > 1:
+            padded_solution, obj = select_best_copy(problem, orig_batch, padded_solution, obj, val_m)
+            batch = orig_batch
+            fallback_steps = fallback_steps.view(val_m, -1)[0]
 
         # statistic
         obj1 = problem.get_costs(batch, padded_solution, flag_finish=True)
@@ -167,13 +196,7 @@ class PPO:
 
         bool_obj_ci = final_obj.view(-1, 1) < cheapest_ins_obj.view(-1, 1)
         bool_obj_mm = final_obj.view(-1, 1) < mm_obj.view(-1, 1)
-        count_obj_ci = torch.sum(final_obj <= cheapest_ins_obj)
-        count_obj_mm = torch.sum(final_obj <= mm_obj)
-
-        sum_diff_obj_ci = torch.sum((final_obj - cheapest_ins_obj)/cheapest_ins_obj)
-        average_diff_obj_ci = sum_diff_obj_ci / final_obj.size(0)
-        sum_diff_obj_mm = torch.sum((final_obj - mm_obj)/mm_obj)
-        average_diff_obj_mm = sum_diff_obj_mm / final_obj.size(0)
+        count_obj_ci, average_diff_obj_ci, count_obj_mm, average_diff_obj_mm = get_val_stats(final_obj, cheapest_ins_obj, mm_obj)
 
 
         out = (padded_solution, # bs, gs
@@ -183,21 +206,26 @@ class PPO:
                average_diff_obj_ci,  # 1
                bool_obj_mm,
                count_obj_mm,
-               average_diff_obj_mm
+               average_diff_obj_mm,
+               fallback_steps # batch_size, steps decided by the CI fallback
                )
         
         return out
     
     
     def start_inference(self, problem, val_dataset, tb_logger):
+        if self.opts.quantize:
+            quantize_actor(get_inner_model(self.actor), self.opts.quant_groups)
         if self.opts.distributed:            
             mp.spawn(validate, nprocs=self.opts.world_size, args=(problem, self, val_dataset, tb_logger, True))
         else:
             validate(0, problem, self, val_dataset, tb_logger, distributed = False)
             
     def start_training(self, problem, train_dataset, val_dataset, tb_logger):
-        if self.opts.distributed:
-            mp.spawn(train, nprocs=self.opts.world_size, args=(problem, self, train_dataset, val_dataset, tb_logger))
+        if self.opts.n_rollout_workers > 0:
+            train_actor_learner(problem, self, train_dataset, val_dataset, tb_logger)
+        elif self.opts.distributed:
+            mp.spawn(train, nprocs=self.opts.nproc_per_node, args=(problem, self, train_dataset, val_dataset, tb_logger))
         else:
             train(0, problem, self, train_dataset, val_dataset, tb_logger)
 
@@ -216,9 +244,18 @@ def train(rank, problem, agent, train_dataset, val_dataset, tb_logger):
         random.seed(opts.seed)
         
     if opts.distributed:
-        device = torch.device("cuda", rank)
-        torch.distributed.init_process_group(backend='nccl', world_size=opts.world_size, rank = rank)
-        torch.cuda.set_device(rank)
+        # mp.spawn gives the local rank on this node, the process group uses the global rank
+        local_rank = rank
+        rank = opts.node_rank * opts.nproc_per_node + local_rank
+        if opts.use_cuda:
+            device = torch.device("cuda", local_rank)
+            torch.cuda.set_device(local_rank)
+        else:
+            # CPU ranks share the cores of the node
+            device = torch.device("cpu")
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // opts.nproc_per_node))
+        opts.device = device
+        torch.distributed.init_process_group(backend=opts.dist_backend, world_size=opts.world_size, rank = rank)
         agent.actor.to(device)
         agent.critic.to(device)
         for state in agent.optimizer.state.values():
@@ -227,10 +264,13 @@ def train(rank, problem, agent, train_dataset, val_dataset, tb_logger):
                         state[k] = v.to(device)
         
 
+        device_ids = [local_rank] if opts.use_cuda else None
         agent.actor = torch.nn.parallel.DistributedDataParallel(agent.actor,
-                                                               device_ids=[rank])
+                                                               device_ids=device_ids,
+                                                               find_unused_parameters=True)
         if not opts.eval_only: agent.critic = torch.nn.parallel.DistributedDataParallel(agent.critic,
-                                                               device_ids=[rank])
+                                                               device_ids=device_ids,
+                                                               find_unused_parameters=True)
         if not opts.no_tb and rank == 0:
             tb_logger = TbLogger(os.path.join(opts.log_dir, "{}_{}".format(opts.problem, 
                                                           opts.graph_size), opts.run_name))
@@ -285,22 +325,177 @@ def train(rank, problem, agent, train_dataset, val_dataset, tb_logger):
             step += 1
         pbar.close()
         
-        # save new model after one epoch  
-        if rank == 0 and not opts.distributed: 
-            if not opts.no_saving and (( opts.checkpoint_epochs != 0 and epoch % opts.checkpoint_epochs == 0) or \
-                        epoch == opts.epoch_end - 1): agent.save(epoch)
-        elif opts.distributed and rank == 1:
+        # save new model after one epoch, only the (global) rank 0 writes checkpoints
+        if rank == 0:
             if not opts.no_saving and (( opts.checkpoint_epochs != 0 and epoch % opts.checkpoint_epochs == 0) or \
                         epoch == opts.epoch_end - 1): agent.save(epoch)
             
         
         # validate the new model   
-        if rank == 0 and not opts.distributed: validate(rank, problem, agent, val_dataset, tb_logger, _id = epoch)
-        if rank == 0 and opts.distributed: validate(rank, problem, agent, val_dataset, tb_logger, _id = epoch)
+        if rank == 0: validate(rank, problem, agent, val_dataset, tb_logger, _id = epoch)
         
         # syn
         if opts.distributed: dist.barrier()
 
+
+def rollout_worker(worker_id, problem, opts, shared_actor, shared_critic, weights_version, weights_lock,
+                   buffers, job_queue, done_queue):
+
+    # each worker keeps a private copy of the networks and refreshes it when the learner publishes new weights
+    warnings.filterwarnings("ignore")
+    torch.manual_seed(opts.seed + worker_id + 1)
+    random.seed(opts.seed + worker_id + 1)
+    torch.set_num_threads(opts.worker_threads)
+
+    actor = copy.deepcopy(shared_actor)
+    critic = copy.deepcopy(shared_critic)
+    actor.train()
+    critic.train()
+    local_version = -1
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        slot, start, batch, epsilon_info = job
+
+        if local_version != weights_version.value:
+            with weights_lock:
+                actor.load_state_dict(shared_actor.state_dict())
+                critic.load_state_dict(shared_critic.state_dict())
+                local_version = weights_version.value
+
+        batch_feature = problem.input_feature_encoding(batch)
+        memory = buffers[slot].narrow(start, batch_feature.size(0))
+        initial_cost, _ = collect_trajectory(problem, actor, critic, batch, batch_feature, memory, epsilon_info)
+        done_queue.put((slot, worker_id, initial_cost))
+
+
+def train_actor_learner(problem, agent, train_dataset, val_dataset, tb_logger):
+
+    # N rollout workers fill shared-memory trajectory buffers while the learner runs the PPO update,
+    # the rollout of the next batch overlaps with the update on the current one (one update of policy lag)
+    opts = agent.opts
+    assert not opts.distributed and opts.device.type == 'cpu', 'actor-learner training runs on CPU in a single node'
+
+    warnings.filterwarnings("ignore")
+    if opts.resume is None:
+        torch.manual_seed(opts.seed)
+        random.seed(opts.seed)
+
+    n_workers = opts.n_rollout_workers
+    opts.worker_threads = max(1, (os.cpu_count() or 1) // (n_workers + 1))
+    torch.set_num_threads(opts.worker_threads)
+
+    # weights are broadcast to the workers through shared memory
+    shared_actor = copy.deepcopy(get_inner_model(agent.actor)).share_memory()
+    shared_critic = copy.deepcopy(get_inner_model(agent.critic)).share_memory()
+    ctx = mp.get_context('spawn')
+    weights_version = ctx.Value('i', 0)
+    weights_lock = ctx.Lock()
+
+    # two trajectory buffers, one being filled by the workers while the learner consumes the other
+    dy_size = problem.size - 2 * problem.static_orders
+    buffers = [RolloutBuffer(dy_size // 2, opts.batch_size, problem.size + 1, 'cpu').share_memory_() for _ in range(2)]
+
+    job_queues = [ctx.Queue() for _ in range(n_workers)]
+    done_queue = ctx.Queue()
+    workers = [ctx.Process(target=rollout_worker,
+                           args=(worker_id, problem, opts, shared_actor, shared_critic, weights_version, weights_lock,
+                                 buffers, job_queues[worker_id], done_queue))
+               for worker_id in range(n_workers)]
+    for worker in workers:
+        worker.start()
+
+    def dispatch(slot, batch, epoch):
+        # split the batch into contiguous shards, one per worker
+        epsilon_info = (opts.epsilon, opts.epsilon_decay, epoch)
+        batch_size = batch['coordinates'].size(0)
+        n_jobs, start = 0, 0
+        for worker_id, length in enumerate(torch.arange(batch_size).tensor_split(n_workers)):
+            length = length.numel()
+            if length == 0:
+                continue
+            shard = {k: v[start:start + length] for k, v in batch.items()}
+            job_queues[worker_id].put((slot, start, shard, epsilon_info))
+            start += length
+            n_jobs += 1
+        return n_jobs
+
+    finished = {0: {}, 1: {}}
+    def collect(slot, n_jobs):
+        # wait until every shard of the slot has been written
+        while len(finished[slot]) < n_jobs:
+            done_slot, worker_id, initial_cost = done_queue.get()
+            finished[done_slot][worker_id] = initial_cost
+        initial_cost = torch.cat([finished[slot][worker_id] for worker_id in sorted(finished[slot])])
+        finished[slot] = {}
+        return initial_cost
+
+    def publish():
+        with weights_lock:
+            shared_actor.load_state_dict(get_inner_model(agent.actor).state_dict())
+            shared_critic.load_state_dict(get_inner_model(agent.critic).state_dict())
+            weights_version.value += 1
+
+    def update(pending, step, pbar):
+        slot, batch, n_jobs = pending
+        initial_cost = collect(slot, n_jobs)
+        agent.train()
+        batch_feature = problem.input_feature_encoding(batch)
+        memory = buffers[slot].narrow(0, batch_feature.size(0))
+        n_fresh = memory.batch_size
+        if agent.replay is not None:
+            memory, batch_feature, initial_cost = mix_replay(agent.replay, memory, batch_feature, initial_cost, opts.replay_ratio)
+        ppo_update(0, problem, agent, memory, batch_feature, initial_cost, step, tb_logger, opts, pbar, n_fresh)
+        publish()
+
+    publish()
+    try:
+        # Start the actual training loop
+        for epoch in range(opts.epoch_start, opts.epoch_end):
+
+            agent.lr_scheduler.step(epoch)
+
+            # Training mode
+            print('\n\n')
+            print("|",format(f" Training epoch {epoch} ","*^60"),"|")
+            print("Training with actor lr={:.3e} critic lr={:.3e} for run {} with {} rollout workers".format(agent.optimizer.param_groups[0]['lr'],
+                                                                                 agent.optimizer.param_groups[1]['lr'], opts.run_name, n_workers) , flush=True)
+            # prepare training data
+            training_dataset = problem.make_dataset(size=opts.graph_size, num_samples=opts.epoch_size,filename=train_dataset)
+            training_dataloader = DataLoader(training_dataset, batch_size=opts.batch_size, shuffle=False,
+                                                       num_workers=0)
+
+            # start training
+            step = epoch * (opts.epoch_size // opts.batch_size)
+            pbar = tqdm(total = (opts.K_epochs) * (opts.epoch_size // opts.batch_size),
+                        disable = opts.no_progress_bar, desc = 'training',
+                        bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}')
+            pending = None
+            for batch_id, batch in enumerate(training_dataloader):
+                slot = batch_id % 2
+                n_jobs = dispatch(slot, batch, epoch)
+                if pending is not None:
+                    update(pending, step - 1, pbar)
+                pending = (slot, batch, n_jobs)
+                step += 1
+            if pending is not None:
+                update(pending, step - 1, pbar)
+            pbar.close()
+
+            # save new model after one epoch
+            if not opts.no_saving and (( opts.checkpoint_epochs != 0 and epoch % opts.checkpoint_epochs == 0) or \
+                        epoch == opts.epoch_end - 1): agent.save(epoch)
+
+            # validate the new model
+            validate(0, problem, agent, val_dataset, tb_logger, _id = epoch)
+    finally:
+        for job_queue in job_queues:
+            job_queue.put(None)
+        for worker in workers:
+            worker.join()
+
     
 def train_batch(
         rank,
@@ -316,213 +511,218 @@ def train_batch(
 
     # setup
     agent.train()
-    memory = Memory()
 
     # prepare the input
-    batch = move_to_cuda(batch, rank) if opts.distributed else move_to(batch, opts.device)# batch_size, graph_size, 2
-    batch_feature = problem.input_feature_encoding(batch).cuda() if opts.distributed \
-                        else move_to(problem.input_feature_encoding(batch), opts.device)
+    batch = move_to(batch, opts.device)# batch_size, graph_size, 2
+    batch_feature = problem.input_feature_encoding(batch)
     batch_size = batch_feature.size(0)
-    exchange = move_to_cuda(torch.tensor([-1,-1,-1]).repeat(batch_size,1), rank) if opts.distributed \
-                        else move_to(torch.tensor([-1,-1,-1]).repeat(batch_size,1), opts.device)
-    
-
-    # print(f"rank {rank}, data from {batch['id'][0]},{batch['id'][1]} , to {batch['id'][-2]},{batch['id'][-1]}")
-
-    # initial solution of the static orders
-
-    solution = move_to_cuda(problem.get_static_solutions(batch),rank) if opts.distributed \
-                        else move_to(problem.get_static_solutions(batch), opts.device)
-    obj = problem.get_costs(batch, solution, flag_finish = False)
-    padded_solution = pad_solution(solution, batch_feature.size(1))
 
     # params for training
-    gamma = opts.gamma
-    n_step = opts.n_step
-    T = opts.T_train
-    K_epochs = opts.K_epochs
-    eps_clip = opts.eps_clip
     epsilon = opts.epsilon   # e-greedy for decoder sampling action
     epsilon_decay = opts.epsilon_decay
     epsilon_info = (epsilon, epsilon_decay, epoch)
 
-    initial_cost = obj
-    
-    # sample trajectory
-
-    memory.actions.append(exchange)
-
-    # data array
-    total_cost = 0
-
-    # for first step
-    entropy = []
-    bl_val_detached = []
-    bl_val = []
-
     dy_size = problem.size - 2 * problem.static_orders
-    t = 0
-    action_his = torch.zeros_like(padded_solution, dtype=torch.bool, device=padded_solution.device)
-    while t < (dy_size // 2):
+    memory = RolloutBuffer(dy_size // 2, batch_size, batch_feature.size(1), batch_feature.device)
 
-        memory.states.append(padded_solution)
+    # the first K-epoch of a whole-batch update can reuse the rollout's own forward pass (its log-probs are those
+    # of the current policy); not with minibatches or replayed samples, nor with batch norm (per-step batch
+    # statistics) or DDP (one forward per backward)
+    n_samples = memory.t_time * batch_size
+    keep_graph = agent.replay is None and not 0 < opts.ppo_minibatch < n_samples and \
+                 opts.normalization != 'batch' and not opts.distributed
 
+    # sample trajectory
+    initial_cost, first_pass = collect_trajectory(problem, agent.actor, agent.critic, batch, batch_feature, memory,
+                                                  epsilon_info, keep_graph)
+    n_fresh = memory.batch_size
+    if agent.replay is not None:
+        memory, batch_feature, initial_cost = mix_replay(agent.replay, memory, batch_feature, initial_cost, opts.replay_ratio)
 
-        # get model output
-        step_info = (dy_size, t)
-        exchange, log_lh, _to_critic, entro_p, CI_action = agent.actor(problem,
-                                                             batch_feature,
-                                                             padded_solution,
-                                                             action_his,
-                                                             step_info,
-                                                             epsilon_info = epsilon_info,
-                                                             do_sample = True,
-                                                             require_entropy = True,# take same action
-                                                             to_critic = True)
+    # begin update        =======================
+    ppo_update(rank, problem, agent, memory, batch_feature, initial_cost, step, tb_logger, opts, pbar, n_fresh, first_pass)
 
-        memory.actions.append(exchange)
-        memory.logprobs.append(log_lh)
 
+def collect_trajectory(problem, actor, critic, batch, batch_feature, memory, epsilon_info, keep_graph = False):
 
-        memory.obj.append(obj.unsqueeze(-1))
+    # initial solution of the static orders
+    solution = problem.get_static_solutions(batch)
+    obj = problem.get_costs(batch, solution, flag_finish = False)
+    padded_solution = pad_solution(solution, batch_feature.size(1))
+    initial_cost = obj
 
+    dy_size = problem.size - 2 * problem.static_orders
 
-        entropy.append(entro_p.detach().cpu())
+    # sample trajectory, the log-probs and values are re-evaluated with gradients in the update;
+    # with keep_graph the per-step outputs keep their graphs for the first K-epoch instead
+    action_his = torch.zeros_like(padded_solution, dtype=torch.bool, device=padded_solution.device)
+    first_pass = []
+    with torch.set_grad_enabled(keep_graph):
+        for t in range(memory.t_time):
 
-        baseline_val_detached, baseline_val = agent.critic(_to_critic, obj.view(obj.size(0), -1)[:,-1].unsqueeze(-1))
+            memory.states[t] = padded_solution
+            memory.obj[t] = obj
 
-        bl_val_detached.append(baseline_val_detached)
-        bl_val.append(baseline_val)
+            # get model output
+            step_info = (dy_size, t)
+            exchange, log_lh, _to_critic, entropy, CI_action = actor(problem,
+                                                                    batch_feature,
+                                                                    padded_solution,
+                                                                    action_his,
+                                                                    step_info,
+                                                                    epsilon_info = epsilon_info,
+                                                                    do_sample = True,
+                                                                    require_entropy = True,
+                                                                    to_critic = True)
+            bl_val_detached, bl_val = critic(_to_critic, obj.view(-1, 1))
+
+            memory.actions[t] = exchange
+            memory.logprobs[t] = log_lh.detach()
+            memory.values[t] = bl_val_detached
+            if keep_graph:
+                first_pass.append((log_lh.view(-1), entropy.detach().view(-1), bl_val_detached.view(-1), bl_val.view(-1)))
+
+            # state transient
+            padded_solution, rewards, obj = problem.step(batch, padded_solution, exchange, obj, CI_action)
+            memory.rewards[t] = rewards
+
+    # flattened like the samples of the update, timestep-major
+    return initial_cost, [torch.cat(x) for x in zip(*first_pass)] if keep_graph else None
+
+
+def mix_replay(replay, memory, batch_feature, initial_cost, replay_ratio):
+    # append replay_ratio * bs stored trajectories after the fresh ones, then store the fresh ones
+    n_replay = min(int(round(replay_ratio * memory.batch_size)), len(replay))
+    fresh = (memory, batch_feature, initial_cost)
+    if n_replay > 0:
+        replay_memory, replay_feature, replay_cost = replay.sample(n_replay)
+        memory = memory.cat(replay_memory)
+        batch_feature = torch.cat((batch_feature, replay_feature.to(batch_feature.dtype)))
+        initial_cost = torch.cat((initial_cost.view(-1), replay_cost))
+    replay.add(*fresh)
+    return memory, batch_feature, initial_cost
+
+
+def ppo_update(
+        rank,
+        problem,
+        agent,
+        memory,
+        batch_feature,
+        initial_cost,
+        step,
+        tb_logger,
+        opts,
+        pbar,
+        n_fresh = None,
+        first_pass = None,
+        ):
 
-        # state transient
-        padded_solution, rewards, obj = problem.step(batch, padded_solution, exchange, obj, CI_action)
-        memory.rewards.append(rewards)
-        # memory.mask_true = memory.mask_true + info['swaped']
+    # params for training
+    gamma = opts.gamma
+    n_step = opts.n_step
+    T = opts.T_train
+    K_epochs = opts.K_epochs
+    eps_clip = opts.eps_clip
 
-        # store info
-        total_cost = total_cost + rewards
+    t_time, batch_size = memory.t_time, memory.batch_size
+    dy_size = problem.size - 2 * problem.static_orders
+    device = batch_feature.device
 
-        # next step
-        t = t + 1
     # store info
-    t_time = dy_size // 2
-    total_cost = total_cost / t_time
-
-    # begin update        =======================
+    total_cost = memory.rewards.mean(0)
 
-    # convert list to tensor
-    all_actions = torch.stack(memory.actions)
-    old_states = torch.stack(memory.states).detach().view(t_time, batch_size, -1)
-    old_actions = all_actions[1:].view(t_time, -1, 3)
-    old_logprobs = torch.stack(memory.logprobs).detach().view(-1)
+    # flatten the (t_time, bs) samples so that all timesteps are re-evaluated together
+    n_samples = t_time * batch_size
+    old_step = torch.arange(t_time, device=device).repeat_interleave(batch_size)
+    old_instance = torch.arange(batch_size, device=device).repeat(t_time)
+    old_states = memory.states.reshape(n_samples, -1).long()
+    old_actions = memory.actions.reshape(n_samples, -1).long()
+    old_action_his = get_action_his(memory.actions.long(), batch_feature.size(1), dy_size // 2)
+    old_logprobs = memory.logprobs.reshape(-1)
+    old_obj = memory.obj.reshape(n_samples, -1)
+    old_value = memory.values.reshape(-1)
 
+    # get traget value for critic
+    Reward = memory.get_returns(gamma, opts.gae_lambda).reshape(-1)
 
-
-    old_obj = torch.stack(memory.obj)
+    # bound the activation memory by splitting the samples into shuffled minibatches
+    minibatch_size = opts.ppo_minibatch if 0 < opts.ppo_minibatch < n_samples else n_samples
 
     # Optimize ppo policy for K mini-epochs:
-    old_value = None
-
     for _k in range(K_epochs):
 
-        if _k == 0:
-            logprobs = memory.logprobs
-
-        else:
-            # Evaluating old actions and values :
-            logprobs = []
-            entropy = []
-            bl_val_detached = []
-            bl_val = []
-
-            action_his = torch.zeros_like(padded_solution, dtype=torch.bool, device=padded_solution.device)
-            for tt in range(t_time):
-                # get new action_prob
-                step_info_ = (dy_size, tt)
-                _, log_p, _to_critic, entro_p, CI_action = agent.actor(problem,
-                                                            batch_feature,
-                                                            old_states[tt],
-                                                            action_his,
-                                                            step_info_,
-                                                            fixed_action = old_actions[tt],
-                                                            require_entropy = True,# take same action
-                                                            to_critic = True)
-
-                logprobs.append(log_p)
-                entropy.append(entro_p.detach().cpu())
-
-                baseline_val_detached, baseline_val = agent.critic(_to_critic, old_obj[tt])
-
-                bl_val_detached.append(baseline_val_detached)
-                bl_val.append(baseline_val)
-
-        logprobs = torch.stack(logprobs).view(-1)
-        entropy = torch.stack(entropy).view(-1)
-        bl_val_detached = torch.stack(bl_val_detached).view(-1)
-        bl_val = torch.stack(bl_val).view(-1)
-
-
-        # get traget value for critic
-        Reward = []
-        reward_reversed = memory.rewards[::-1]
-
-        # estimate return
-        R = 0
-        for r in range(len(reward_reversed)):
-            R = R * gamma + reward_reversed[r]
-            Reward.append(R)
-
-
-        # clip the target:
-        Reward = torch.stack(Reward[::-1], 0) # n_step, bs
-        Reward = Reward.view(-1)
-
-        # Finding the ratio (pi_theta / pi_theta__old):
-        ratios = torch.exp(logprobs - old_logprobs.detach())
-
-        # Finding Surrogate Loss:
-        advantages = Reward - bl_val_detached
-
-        surr1 = ratios * advantages
-        surr2 = torch.clamp(ratios, 1-eps_clip, 1+eps_clip) * advantages
-        reinforce_loss = -torch.min(surr1, surr2).mean()
-
-        # define baseline loss
-        if old_value is None:
-            baseline_loss = ((bl_val - Reward) ** 2).mean()
-            old_value = bl_val.detach()
-        else:
-            vpredclipped = old_value + torch.clamp(bl_val - old_value, - eps_clip, eps_clip)
-            v_max = torch.max(((bl_val - Reward) ** 2), ((vpredclipped - Reward) ** 2))
+        minibatches = torch.randperm(n_samples, device=device).split(minibatch_size) \
+                        if minibatch_size < n_samples else [slice(None)]
+
+        for mb in minibatches:
+
+            if _k == 0 and first_pass is not None:
+                # the rollout's own pass of the whole batch, the current policy has not been updated yet
+                logprobs, entropy, bl_val_detached, bl_val = first_pass
+            else:
+                # Evaluating old actions and values of the sampled timesteps at once:
+                _, logprobs, _to_critic, entropy, _ = agent.actor(problem,
+                                                                  batch_feature[old_instance[mb]],
+                                                                  old_states[mb],
+                                                                  old_action_his[mb].clone(),
+                                                                  (dy_size, old_step[mb]),
+                                                                  fixed_action = old_actions[mb],
+                                                                  require_entropy = True,# take same action
+                                                                  to_critic = True)
+
+                bl_val_detached, bl_val = agent.critic(_to_critic, old_obj[mb])
+
+                logprobs = logprobs.view(-1)
+                entropy = entropy.detach().view(-1)
+                bl_val_detached = bl_val_detached.view(-1)
+                bl_val = bl_val.view(-1)
+            mb_Reward = Reward[mb]
+            mb_old_logprobs = old_logprobs[mb]
+            mb_old_value = old_value[mb]
+
+            # Finding the ratio (pi_theta / pi_theta__old):
+            ratios = torch.exp(logprobs - mb_old_logprobs)
+            if n_fresh is not None and n_fresh < batch_size:
+                # replayed trajectories (the instances after the n_fresh fresh ones) come from older policies,
+                # truncate their importance ratios, the fresh samples keep the plain PPO clip
+                replayed = old_instance[mb] >= n_fresh
+                ratios = torch.where(replayed, ratios.clamp(max = opts.replay_is_clip), ratios)
+
+            # Finding Surrogate Loss:
+            advantages = mb_Reward - bl_val_detached
+
+            surr1 = ratios * advantages
+            surr2 = torch.clamp(ratios, 1-eps_clip, 1+eps_clip) * advantages
+            reinforce_loss = -torch.min(surr1, surr2).mean()
+
+            # define baseline loss, clipped around the values seen during the rollout
+            vpredclipped = mb_old_value + torch.clamp(bl_val - mb_old_value, - eps_clip, eps_clip)
+            v_max = torch.max(((bl_val - mb_Reward) ** 2), ((vpredclipped - mb_Reward) ** 2))
             baseline_loss = v_max.mean()
 
-        # check K-L divergence
-        approx_kl_divergence = (.5 * (old_logprobs.detach() - logprobs) ** 2).mean().detach()
-        approx_kl_divergence[torch.isinf(approx_kl_divergence)] = 0
+            # check K-L divergence
+            approx_kl_divergence = (.5 * (mb_old_logprobs - logprobs) ** 2).mean().detach()
+            approx_kl_divergence[torch.isinf(approx_kl_divergence)] = 0
 
-        # calculate loss
-        loss = baseline_loss + reinforce_loss #- 1e-5 * entropy.mean()
+            # calculate loss
+            loss = baseline_loss + reinforce_loss #- 1e-5 * entropy.mean()
 
-        # update gradient step
-        agent.optimizer.zero_grad()
-        loss.backward()
+            # update gradient step
+            agent.optimizer.zero_grad()
+            loss.backward()
 
-        # Clip gradient norm and get (clipped) gradient norms for logging
-        current_step = int(step * T / n_step * K_epochs + (t-1)//n_step * K_epochs  + _k)
-        grad_norms = clip_grad_norms(agent.optimizer.param_groups, opts.max_grad_norm)
+            # Clip gradient norm and get (clipped) gradient norms for logging
+            grad_norms = clip_grad_norms(agent.optimizer.param_groups, opts.max_grad_norm)
 
-        # perform gradient descent
-        agent.optimizer.step()
+            # perform gradient descent
+            agent.optimizer.step()
 
         # Logging to tensorboard
+        current_step = int(step * T / n_step * K_epochs + (t_time-1)//n_step * K_epochs  + _k)
         if(not opts.no_tb) and rank == 0:
             if (current_step + 1) % int(opts.log_step) == 0:
-                log_to_tb_train(tb_logger, agent, Reward, ratios, bl_val_detached, total_cost, grad_norms, memory.rewards, entropy, approx_kl_divergence,
+                log_to_tb_train(tb_logger, agent, mb_Reward, ratios, bl_val_detached, total_cost, grad_norms, memory.rewards, entropy, approx_kl_divergence,
                    reinforce_loss, baseline_loss, logprobs, initial_cost, current_step + 1)
 
         if rank == 0: pbar.update(1)
-
-
-    # end update
-    memory.clear_memory()
-
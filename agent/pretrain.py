@@ -0,0 +1,110 @@
+import time
+import warnings
+import random
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+from torch.utils.data import DataLoader
+
+from nets.graph_layers import EmbeddingNet
+from utils.utils import clip_grad_norms, move_to, pad_solution
+from utils.logger import log_to_tb_pretrain, log_metrics_to_screen
+from agent.distill import get_tables
+from agent.utils import evaluate_agents
+
+
+def get_ci_action(problem, x_in, solution, action_his, step_info):
+    # cheapest insertion over all un-inserted orders, among the pairs the reinsertion head may choose: bs, 3
+    dy_size, _ = step_info
+    bs, gs = solution.size()
+    n_orders = dy_size // 2
+    _, visited_time = EmbeddingNet.get_visited_time(solution, step_info)
+    visited_order_map = problem.get_visited_order_map(visited_time, step_info)
+
+    # one state per (instance, order)
+    pickups = torch.arange(gs - dy_size, gs - n_orders, device = solution.device).repeat(bs).view(-1, 1)
+    action_his_r = action_his.repeat_interleave(n_orders, 0)
+    inserted = action_his_r.gather(1, pickups).view(-1)
+    action_his_r.scatter_(1, pickups, True)
+    action_his_r.scatter_(1, pickups + n_orders, True)
+    mask_table = problem.get_swap_mask(pickups, visited_order_map.repeat_interleave(n_orders, 0), step_info, action_his_r)
+    cost = problem.get_insertion_cost_table(x_in.repeat_interleave(n_orders, 0), solution.repeat_interleave(n_orders, 0), pickups)
+    cost[mask_table] = float('inf')
+    cost[inserted] = float('inf')
+
+    best = cost.view(bs, -1).min(-1)[1]
+    pair_index = best % (gs * gs)
+    action_removal = pickups.view(bs, n_orders).gather(1, (best // (gs * gs)).view(-1, 1))
+    return torch.cat((action_removal, (pair_index // gs).view(-1, 1), (pair_index % gs).view(-1, 1)), -1)
+
+
+def pretrain_batch(problem, actor, optimizer, batch, opts):
+    # behaviour cloning along the cheapest insertion trajectory of the batch (cross-entropy on both heads)
+    batch = move_to(batch, opts.device)
+    x_in = problem.input_feature_encoding(batch)
+    solution = pad_solution(move_to(problem.get_static_solutions(batch), opts.device).long(), x_in.size(1))
+    action_his = torch.zeros_like(solution, dtype = torch.bool)
+    dy_size = problem.size - 2 * problem.static_orders
+    n_steps = dy_size // 2
+    gs = solution.size(1)
+
+    optimizer.zero_grad()
+    loss_removal, loss_reinsertion, acc_removal, acc_reinsertion = 0., 0., 0., 0.
+    for t in range(n_steps):
+        step_info = (dy_size, t)
+        with torch.no_grad():
+            ci_action = get_ci_action(problem, x_in, solution, action_his, step_info)
+        removal_table, reinsertion_table, removal_mask, mask_table, _, new_action_his = \
+            get_tables(actor, problem, x_in, solution, action_his, step_info, ci_action[:, :1])
+        removal_table = removal_table.masked_fill(removal_mask, -1e20)
+        reinsertion_table = reinsertion_table.masked_fill(mask_table, -1e20)
+        target_pair = ci_action[:, 1] * gs + ci_action[:, 2]
+        step_removal = F.cross_entropy(removal_table, ci_action[:, 0])
+        step_reinsertion = F.cross_entropy(reinsertion_table, target_pair)
+        ((step_removal + step_reinsertion) / n_steps).backward()
+
+        loss_removal += step_removal.item() / n_steps
+        loss_reinsertion += step_reinsertion.item() / n_steps
+        acc_removal += (removal_table.max(-1)[1] == ci_action[:, 0]).float().mean().item() / n_steps
+        acc_reinsertion += (reinsertion_table.max(-1)[1] == target_pair).float().mean().item() / n_steps
+
+        solution = problem.insert_star(solution, ci_action[:, :1], ci_action[:, 1:2], ci_action[:, 2:3])
+        action_his = new_action_his
+
+    grad_norms = clip_grad_norms(optimizer.param_groups, opts.max_grad_norm)
+    optimizer.step()
+    return (loss_removal, loss_reinsertion), (acc_removal, acc_reinsertion), grad_norms
+
+
+def pretrain(problem, agent, train_dataset, val_dataset, tb_logger):
+    # warm-start the actor by cloning cheapest insertion for bc_epochs before the RL epochs,
+    # with its own optimizer so that the PPO optimizer state starts clean
+    opts = agent.opts
+    warnings.filterwarnings("ignore")
+    torch.manual_seed(opts.seed)
+    random.seed(opts.seed)
+
+    optimizer = torch.optim.Adam(agent.actor.parameters(), lr = opts.lr_bc)
+    val_dataloader = DataLoader(problem.make_dataset(filename = val_dataset, size = opts.graph_size,
+                                                     num_samples = opts.val_size, flag_val = True),
+                                batch_size = opts.val_batch_size, shuffle = False, num_workers = 0)
+    step = 0
+    s_time = time.time()
+    for epoch in range(opts.bc_epochs):
+        print('\n\n')
+        print("|", format(f" Behaviour cloning epoch {epoch} ", "*^60"), "|")
+        training_dataloader = DataLoader(problem.make_dataset(size = opts.graph_size, num_samples = opts.epoch_size, filename = train_dataset),
+                                         batch_size = opts.batch_size, shuffle = False, num_workers = 0)
+        agent.train()
+        for batch in tqdm(training_dataloader, disable = opts.no_progress_bar, desc = 'behaviour cloning',
+                          bar_format = '{l_bar}{bar:20}{r_bar}{bar:-20b}'):
+            losses, accuracies, grad_norms = pretrain_batch(problem, agent.actor, optimizer, batch, opts)
+            if tb_logger is not None and step % int(opts.log_step) == 0:
+                log_to_tb_pretrain(tb_logger, losses, accuracies, grad_norms, step)
+            step += 1
+        print('CE removal {:.6f} reinsertion {:.6f}, CI agreement removal {:.4f} reinsertion {:.4f}'.format(*losses, *accuracies))
+
+        summary = evaluate_agents([agent], problem, val_dataloader)[0]
+        print('Wall time {:.1f}s, gap to cheapest insertion {:.6f}'.format(time.time() - s_time, summary['gap_ci']['mean']))
+        log_metrics_to_screen(summary)
+    agent.train()
@@ -0,0 +1,189 @@
+import json
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+
+class ServerMetrics:
+    # counters and sliding windows of the serving path, read by the /metrics endpoint
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self, window = 10000):
+        self.lock = threading.Lock()
+        self.n_requests = 0
+        self.n_batches = 0
+        self.n_errors = 0
+        self.queue_depth = deque(maxlen = window)
+        self.batch_fill = deque(maxlen = window)
+        self.latency = deque(maxlen = window)
+        self.compute_time = deque(maxlen = window)
+
+    def record_batch(self, queue_depth, batch_size, max_batch, compute_time, latencies):
+        with self.lock:
+            self.n_batches += 1
+            self.n_requests += batch_size
+            self.queue_depth.append(queue_depth)
+            self.batch_fill.append(batch_size / max_batch)
+            self.compute_time.append(compute_time)
+            self.latency.extend(latencies)
+
+    def record_error(self, n = 1):
+        with self.lock:
+            self.n_errors += n
+
+    @classmethod
+    def describe(cls, values):
+        values = np.asarray(values, dtype = np.float64)
+        if values.size == 0:
+            return {'count': 0}
+        out = {'count': int(values.size), 'mean': float(values.mean())}
+        for q, v in zip(cls.PERCENTILES, np.percentile(values, cls.PERCENTILES)):
+            out['p{}'.format(q)] = float(v)
+        return out
+
+    def summary(self):
+        with self.lock:
+            return {
+                'n_requests': self.n_requests,
+                'n_batches': self.n_batches,
+                'n_errors': self.n_errors,
+                'queue_depth': self.describe(self.queue_depth),
+                'batch_fill': self.describe(self.batch_fill),
+                'latency': self.describe(self.latency),
+                'compute_time': self.describe(self.compute_time),
+            }
+
+
+class BatchScheduler:
+    # collects concurrent insertion requests for up to max_wait seconds or max_batch requests and
+    # serves them with batched Inserter calls from a single thread.
+    # requests are grouped by exact shape (static orders, new orders): the encoder attends over every
+    # node without a key mask, so padding smaller graphs to a common size would change their actions.
+    def __init__(self, inserter, max_batch = 32, max_wait = 0.005):
+        self.inserter = inserter
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.metrics = ServerMetrics()
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.requests.put(None)
+        self.thread.join()
+
+    def submit(self, coordinates, route, dynamic_loc):
+        future = Future()
+        self.requests.put((torch.as_tensor(coordinates, dtype = torch.float),
+                           torch.as_tensor(route, dtype = torch.long),
+                           torch.as_tensor(dynamic_loc, dtype = torch.float),
+                           future, time.perf_counter()))
+        return future
+
+    def collect(self):
+        # block for the first request, then fill the batch until it is full or the wait expires
+        first = self.requests.get()
+        if first is None:
+            return []
+        pending = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(pending) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout = timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                self.running = False
+                break
+            pending.append(request)
+        return pending
+
+    def run(self):
+        while self.running:
+            pending = self.collect()
+            queue_depth = self.requests.qsize()
+            groups = {}
+            for request in pending:
+                groups.setdefault((request[0].size(0), request[2].size(0)), []).append(request)
+            for group in groups.values():
+                self.serve(group, queue_depth)
+
+    def serve(self, group, queue_depth):
+        s_time = time.perf_counter()
+        try:
+            coordinates, route, dynamic_loc = [torch.stack(x) for x in list(zip(*group))[:3]]
+            actions, solution, obj = self.inserter.insert(coordinates, route, dynamic_loc)
+        except Exception as e:
+            self.metrics.record_error(len(group))
+            for request in group:
+                request[3].set_exception(e)
+            return
+        done_time = time.perf_counter()
+        actions, solution, obj = actions.cpu().tolist(), solution.cpu().tolist(), obj.cpu().tolist()
+        for i, request in enumerate(group):
+            request[3].set_result({'actions': actions[i], 'route': solution[i], 'cost': obj[i],
+                                   'batch_size': len(group)})
+        self.metrics.record_batch(queue_depth, len(group), self.max_batch, done_time - s_time,
+                                  [done_time - request[4] for request in group])
+
+
+class InsertionHandler(BaseHTTPRequestHandler):
+    # POST /insert with {"coordinates", "route", "dynamic_loc"}, GET /metrics
+    scheduler = None
+
+    def send_json(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            summary = self.scheduler.metrics.summary()
+            if self.scheduler.inserter.cache is not None:
+                summary['cache'] = self.scheduler.inserter.cache.stats()
+            self.send_json(200, summary)
+        else:
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/insert':
+            self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            future = self.scheduler.submit(request['coordinates'], request['route'], request['dynamic_loc'])
+            self.send_json(200, future.result())
+        except Exception as e:
+            self.send_json(400, {'error': repr(e)})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InsertionServer(ThreadingHTTPServer):
+    # the default listen backlog of 5 makes bursts of clients wait for tcp retransmits
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def make_server(scheduler, host = '127.0.0.1', port = 8765):
+    handler = type('Handler', (InsertionHandler,), {'scheduler': scheduler})
+    return InsertionServer((host, port), handler)
@@ -1,20 +1,266 @@
 # -*- coding: utf-8 -*-
 
+import copy
 import time
 import torch
+import numpy as np
 import os
 from tqdm import tqdm
-from utils.logger import log_to_screen, log_to_tb_val, log_to_screen_and_file
+from utils.logger import log_to_screen, log_to_tb_val, log_to_screen_and_file, log_metrics_to_screen, log_to_tb_metrics
+from utils.metrics import MetricsAccumulator
+from utils.utils import rotate_tensor
+from utils.result_writer import ResultWriter
 import torch.distributed as dist
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, BatchSampler, SequentialSampler
 from tensorboard_logger import Logger as TbLogger
 import random
+import traceback
+import torch.multiprocessing as mp
 
 def gather_tensor_and_concat(tensor):
     gather_t = [torch.ones_like(tensor) for _ in range(dist.get_world_size())]
     dist.all_gather(gather_t, tensor)
     return torch.cat(gather_t)
 
+class RolloutBuffer:
+    # preallocated (t_time, bs) storage of one batch of trajectories
+    def __init__(self, t_time, batch_size, graph_size, device):
+        self.t_time = t_time
+        self.batch_size = batch_size
+        route_dtype = torch.int16 if graph_size <= torch.iinfo(torch.int16).max else torch.int32
+        self.states = torch.zeros((t_time, batch_size, graph_size), dtype=route_dtype, device=device)
+        self.actions = torch.zeros((t_time, batch_size, 3), dtype=route_dtype, device=device)
+        self.logprobs = torch.zeros((t_time, batch_size), device=device)
+        self.rewards = torch.zeros((t_time, batch_size), device=device)
+        self.values = torch.zeros((t_time, batch_size), device=device)
+        self.obj = torch.zeros((t_time, batch_size), device=device)
+
+    FIELDS = ('states', 'actions', 'logprobs', 'rewards', 'values', 'obj')
+
+    def share_memory_(self):
+        for key in self.FIELDS:
+            getattr(self, key).share_memory_()
+        return self
+
+    def narrow(self, start, length):
+        # view on the instances [start, start + length), writing to it fills this buffer
+        shard = copy.copy(self)
+        shard.batch_size = length
+        for key in self.FIELDS:
+            setattr(shard, key, getattr(self, key).narrow(1, start, length))
+        return shard
+
+    def index_select(self, index):
+        # copy of the trajectories of the given instances
+        shard = copy.copy(self)
+        shard.batch_size = index.numel()
+        for key in self.FIELDS:
+            setattr(shard, key, getattr(self, key).index_select(1, index))
+        return shard
+
+    def cat(self, other):
+        # the trajectories of both buffers, those of other after those of self
+        merged = copy.copy(self)
+        merged.batch_size = self.batch_size + other.batch_size
+        for key in self.FIELDS:
+            setattr(merged, key, torch.cat((getattr(self, key), getattr(other, key)), 1))
+        return merged
+
+    def discount(self, x, factor):
+        # y_t = sum_{j >= t} factor^(j - t) * x_j, as one (t_time, t_time) x (t_time, bs) matmul
+        offset = torch.arange(self.t_time, device=x.device)
+        offset = offset.view(1, -1) - offset.view(-1, 1)
+        weights = torch.pow(torch.tensor(float(factor), device=x.device), offset.clamp(min=0).float())
+        weights[offset < 0] = 0
+        return weights @ x
+
+    def get_returns(self, gamma, gae_lambda = 1.):
+        # lambda-returns as the critic target, gae_lambda = 1 gives the Monte-Carlo discounted return
+        if gae_lambda == 1:
+            return self.discount(self.rewards, gamma)
+        return self.get_gae(gamma, gae_lambda) + self.values
+
+    def get_gae(self, gamma, gae_lambda):
+        next_values = torch.cat((self.values[1:], torch.zeros_like(self.values[:1])), 0)
+        deltas = self.rewards + gamma * next_values - self.values
+        return self.discount(deltas, gamma * gae_lambda)
+
+
+class StepTimeEstimate:
+    # decaying (EMA) estimate of the model step time per batch shape for the deadline-aware rollout;
+    # the first step of a shape and steps that compiled a graph are not representative and are skipped
+    def __init__(self, decay = 0.9):
+        self.decay = decay
+        self.estimates = {}
+        self.seen = set()
+
+    def get(self, shape):
+        return self.estimates.get(shape, 0.)
+
+    def update(self, shape, step_time, compiled = False):
+        if shape not in self.seen or compiled:
+            self.seen.add(shape)
+            return
+        estimate = self.estimates.get(shape)
+        self.estimates[shape] = step_time if estimate is None else self.decay * estimate + (1 - self.decay) * step_time
+
+
+class ReplayStore:
+    # bounded store of recent trajectories (one slot per instance) that the PPO update mixes with the fresh ones;
+    # once full, new trajectories replace the oldest ones (fifo) or uniformly chosen ones (random)
+    def __init__(self, capacity, evict = 'fifo'):
+        assert evict in ('fifo', 'random')
+        self.capacity = capacity
+        self.evict = evict
+        self.size = 0
+        self.next_slot = 0
+        self.memory = None
+
+    def __len__(self):
+        return self.size
+
+    def add(self, memory, batch_feature, initial_cost):
+        if self.memory is None:
+            device = batch_feature.device
+            self.memory = RolloutBuffer(memory.t_time, self.capacity, memory.states.size(-1), device)
+            self.batch_feature = torch.zeros((self.capacity, ) + batch_feature.shape[1:], device=device)
+            self.initial_cost = torch.zeros(self.capacity, device=device)
+        n = min(memory.batch_size, self.capacity)
+        if self.evict == 'fifo':
+            slots = (self.next_slot + torch.arange(n)) % self.capacity
+            self.next_slot = (self.next_slot + n) % self.capacity
+        else:
+            free = torch.arange(self.size, min(self.size + n, self.capacity))
+            slots = torch.cat((free, torch.randperm(self.size)[:n - free.numel()]))
+        slots = slots.to(self.initial_cost.device)
+        for key in RolloutBuffer.FIELDS:
+            getattr(self.memory, key)[:, slots] = getattr(memory, key)[:, -n:].to(getattr(self.memory, key).dtype)
+        self.batch_feature[slots] = batch_feature[-n:].float()
+        self.initial_cost[slots] = initial_cost.view(-1)[-n:].float()
+        self.size = min(self.size + n, self.capacity)
+
+    def sample(self, n):
+        # n distinct stored trajectories (at most all of them) with their features and initial costs
+        index = torch.randperm(self.size)[:n].to(self.initial_cost.device)
+        return self.memory.index_select(index), self.batch_feature[index], self.initial_cost[index]
+
+
+def get_action_his(actions, gs, dy_half_pos):
+    # rebuild the inserted-order history seen at each timestep from the (t_time, bs, 3) action record,
+    # entry [tt, b] marks the orders inserted before step tt, flattened to (t_time * bs, gs)
+    t_time, bs, _ = actions.size()
+    removal = actions[:, :, :1].long()
+    inserted = torch.zeros((t_time, bs, gs), dtype=torch.long, device=actions.device)
+    inserted.scatter_(2, removal, 1)
+    inserted.scatter_(2, removal + dy_half_pos, 1)
+    return ((inserted.cumsum(0) - inserted) > 0).view(t_time * bs, gs)
+
+def augment_batch(batch, val_m, mode):
+    # stack val_m copies of every instance, copy c of instance i sits at c * bs + i
+    # for rotate / both, copy c is rotated by 360 * c / val_m degrees around the centre of the unit square
+    aug_batch = {key: value.repeat(val_m, *([1] * (value.dim() - 1))) for key, value in batch.items()}
+    if mode in ('rotate', 'both'):
+        for key in ('coordinates', 'dynamic_loc'):
+            aug_batch[key] = torch.cat([rotate_tensor(batch[key], 360. * c / val_m) for c in range(val_m)])
+    return aug_batch
+
+def select_best_copy(problem, batch, padded_solution, obj, val_m):
+    # keep the cheapest of the val_m routes of every instance, costed on the original coordinates
+    bs = obj.size(0) // val_m
+    best = obj.view(val_m, bs).min(0)[1]
+    padded_solution = padded_solution.view(val_m, bs, -1)[best, torch.arange(bs, device=best.device)]
+    return padded_solution, problem.get_costs(batch, padded_solution)
+
+def get_val_stats(final_obj, cheapest_ins_obj, mm_obj):
+    # number of instances no worse than the baselines and the average relative gaps
+    count_obj_ci = torch.sum(final_obj <= cheapest_ins_obj)
+    count_obj_mm = torch.sum(final_obj <= mm_obj)
+    average_diff_obj_ci = torch.sum((final_obj - cheapest_ins_obj)/cheapest_ins_obj) / final_obj.size(0)
+    average_diff_obj_mm = torch.sum((final_obj - mm_obj)/mm_obj) / final_obj.size(0)
+    return count_obj_ci, average_diff_obj_ci, count_obj_mm, average_diff_obj_mm
+
+def evaluate_agents(agents, problem, dataloader):
+    # greedy rollout of every batch by every agent (same model class, different actors), gaps and latencies as in
+    # validate; the agents take turns on each batch so that drifting machine load affects them alike
+    metrics = [MetricsAccumulator() for _ in agents]
+    with torch.no_grad():
+        for agent in agents:
+            agent.eval()
+            agent.rollout(problem, next(iter(dataloader)))  # warm-up
+        for batch in dataloader:
+            for agent, metric in zip(agents, metrics):
+                s_time = time.time()
+                out = agent.rollout(problem, batch)
+                metric.update(out[1], batch['ci_obj'], batch['mm_obj'], time.time() - s_time)
+    return [metric.summary() for metric in metrics]
+
+
+def with_actor(agent, actor):
+    # shallow copy of an agent decoding with another actor
+    agent = copy.copy(agent)
+    agent.actor = actor
+    return agent
+
+
+def validate_worker(worker_id, n_workers, problem, agent, queue):
+    # roll out every n_workers-th batch of the validation set, results are sent back as numpy arrays
+    try:
+        opts = agent.opts
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // n_workers))
+        torch.manual_seed(opts.seed)
+        random.seed(opts.seed)
+        agent.eval()
+
+        val_dataset = problem.make_dataset(filename=opts.val_dataset, size=opts.graph_size,
+                                   num_samples=opts.val_size,
+                                   flag_val=True)
+        batches = list(BatchSampler(SequentialSampler(val_dataset), opts.val_batch_size, drop_last=False))
+        val_dataloader = DataLoader(val_dataset, batch_sampler=batches[worker_id::n_workers], num_workers=0)
+
+        for batch_id, batch in zip(range(worker_id, len(batches), n_workers), val_dataloader):
+            batch_time = time.time()
+            out = agent.rollout(problem, batch, do_sample = False)
+            batch_time = time.time() - batch_time
+            queue.put((batch_id, out[0].cpu().numpy(), out[1].cpu().numpy(),
+                       batch['ci_obj'].numpy(), batch['mm_obj'].numpy(), out[-1].cpu().numpy(), batch_time))
+        queue.put((None, worker_id, None))
+    except Exception:
+        queue.put((None, worker_id, traceback.format_exc()))
+
+def validate_with_workers(problem, agent, n_workers):
+    # shard the validation batches over CPU worker processes and yield the batch results in dataset order
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    workers = [ctx.Process(target=validate_worker, args=(worker_id, n_workers, problem, agent, queue))
+               for worker_id in range(n_workers)]
+    for worker in workers:
+        worker.start()
+
+    # out-of-order batches wait in pending until all the batches before them have arrived
+    pending = {}
+    next_batch_id = 0
+    n_finished = 0
+    pbar = tqdm(desc = 'inference', bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}', disable = agent.opts.no_progress_bar)
+    try:
+        while n_finished < n_workers:
+            batch_id, *out = queue.get()
+            if batch_id is None:
+                n_finished += 1
+                if out[1] is not None:
+                    raise RuntimeError('validation worker {} failed:\n{}'.format(out[0], out[1]))
+                continue
+            pending[batch_id] = [torch.from_numpy(x) for x in out[:-1]] + out[-1:]
+            pbar.update(1)
+            while next_batch_id in pending:
+                yield pending.pop(next_batch_id)
+                next_batch_id += 1
+    finally:
+        pbar.close()
+        for worker in workers:
+            if worker.is_alive() and n_finished < n_workers:
+                worker.terminate()
+            worker.join()
+
 def validate(rank, problem, agent, val_dataset, tb_logger, distributed = False, _id = None):
             
     # Validate mode
@@ -32,13 +278,15 @@ def validate(rank, problem, agent, val_dataset, tb_logger, distributed = False,
                                flag_val=True)
 
     if distributed and opts.distributed:
-        device = torch.device("cuda", rank)
-        torch.distributed.init_process_group(backend='nccl', world_size=opts.world_size, rank = rank)
-        torch.cuda.set_device(rank)
+        if opts.use_cuda:
+            device = torch.device("cuda", rank)
+            torch.cuda.set_device(rank)
+        else:
+            device = torch.device("cpu")
+            torch.set_num_threads(max(1, (os.cpu_count() or 1) // opts.world_size))
+        opts.device = device
+        torch.distributed.init_process_group(backend=opts.dist_backend, world_size=opts.world_size, rank = rank)
         agent.actor.to(device)
-        if torch.cuda.device_count() > 1:
-            agent.actor = torch.nn.parallel.DistributedDataParallel(agent.actor,
-                                                                   device_ids=[rank])
         if not opts.no_tb and rank == 0:
             tb_logger = TbLogger(os.path.join(opts.log_dir, "{}_{}".format(opts.problem, 
                                                           opts.graph_size), opts.run_name))
@@ -56,36 +304,77 @@ def validate(rank, problem, agent, val_dataset, tb_logger, distributed = False,
                                    num_workers=0,
                                    pin_memory=True)
     
-    s_time = time.time()
-
-    for batch in tqdm(val_dataloader, desc = 'inference', bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}'):
-        padded_solution, final_obj, bool_obj_ci, count_obj_ci, average_diff_obj_ci, bool_obj_mm, count_obj_mm, average_diff_obj_mm = agent.rollout(problem,batch, do_sample = False, show_bar = rank==0)
+    def rollout_batches():
+        for batch in tqdm(val_dataloader, desc = 'inference', bar_format='{l_bar}{bar:20}{r_bar}{bar:-20b}'):
+            batch_time = time.time()
+            out = agent.rollout(problem,batch, do_sample = False, show_bar = rank==0)
+            yield out[0].cpu(), out[1].cpu(), batch['ci_obj'].view(-1), batch['mm_obj'].view(-1), out[-1].cpu(), time.time() - batch_time
 
+    s_time = time.time()
 
+    # per-instance metrics are accumulated batch by batch, the routes are streamed to disk and dropped
+    metrics = MetricsAccumulator()
+    writer = None
+    result_path = opts.result_path
+    if result_path is not None and distributed and opts.distributed:
+        result_path = '{}.rank{}'.format(result_path, rank)
+    if opts.val_workers > 1:
+        results = validate_with_workers(problem, agent, opts.val_workers)
+    else:
+        results = rollout_batches()
+    n_seen = 0
+    for padded_solution, final_obj, cheapest_ins_obj, mm_obj, fallback_steps, batch_time in results:
+        index = torch.arange(n_seen, n_seen + padded_solution.size(0))
+        if distributed and opts.distributed:
+            # the sampler deals instance i to rank i % world_size and pads the last round with repeats
+            index = index * opts.world_size + rank
+        valid = index < len(val_dataset)
+        metrics.update(final_obj[valid], cheapest_ins_obj[valid], mm_obj[valid], batch_time, fallback_steps[valid])
+        if result_path is not None:
+            if writer is None:
+                writer = ResultWriter(result_path, padded_solution.size(1))
+            writer.write(index[valid].numpy(), padded_solution[valid].numpy(), final_obj[valid].numpy(),
+                         np.full(int(valid.sum()), batch_time))
+        n_seen += padded_solution.size(0)
+    if writer is not None:
+        writer.close()
         
     if distributed and opts.distributed: dist.barrier()
     
     if distributed and opts.distributed:
-        # initial_cost = gather_tensor_and_concat(cost_hist[:,0].contiguous())
-        # time_used = gather_tensor_and_concat(torch.tensor([time.time() - s_time]).cuda())
-        # bv = gather_tensor_and_concat(bv.contiguous())
-        # costs_history = gather_tensor_and_concat(cost_hist.contiguous())
-        # search_history = gather_tensor_and_concat(best_hist.contiguous())
-        # reward = gather_tensor_and_concat(r.contiguous())
-        pass
+        # the padded repeats were left out above, the per-rank accumulators are merged
+        metrics.gather(lambda x: gather_tensor_and_concat(x.to(opts.device)).cpu())
+        time_used = gather_tensor_and_concat(torch.tensor([time.time() - s_time], device=opts.device)).max().cpu()
     
     else:
 
         time_used = torch.tensor([time.time() - s_time]) # bs
 
+    # statistic over the whole validation set
+    summary = metrics.summary()
+    count_obj_ci, average_diff_obj_ci, count_obj_mm, average_diff_obj_mm = \
+        summary['count_obj_ci'], summary['gap_ci']['mean'], summary['count_obj_mm'], summary['gap_mm']['mean']
         
     if distributed and opts.distributed: dist.barrier()
         
     # log to screen  
-    if rank == 0: log_to_screen_and_file(time_used,
-                                  count_obj_ci, average_diff_obj_ci, count_obj_mm, average_diff_obj_mm,
-                                  batch_size = opts.val_size,
-                                  dataset_size = len(val_dataset),output_file_path='./print.txt', epoch = _id)
+    if rank == 0:
+        log_to_screen_and_file(time_used,
+                               count_obj_ci, average_diff_obj_ci, count_obj_mm, average_diff_obj_mm,
+                               batch_size = opts.val_size,
+                               dataset_size = len(val_dataset),output_file_path='./print.txt', epoch = _id)
+        log_metrics_to_screen(summary)
+        metrics_path = opts.metrics_path if opts.metrics_path is not None else \
+                            (os.path.join(opts.save_dir, 'val_metrics.json') if opts.save_dir is not None else None)
+        if metrics_path is not None:
+            metrics.to_json(metrics_path, epoch = _id, wall_time = float(time_used.max()))
+        if writer is not None:
+            print('Solutions written to {}'.format(opts.result_path if not (distributed and opts.distributed)
+                                                   else opts.result_path + '.rank*'))
+
+    # log to tb
+    if(not opts.no_tb) and rank == 0 and tb_logger is not None:
+        log_to_tb_metrics(tb_logger, summary, 0 if _id is None else _id)
     
     # log to tb
     # if(not opts.no_tb) and rank == 0:
@@ -103,4 +392,6 @@ def validate(rank, problem, agent, val_dataset, tb_logger, distributed = False,
     #                   epoch = _id)
     
     if distributed and opts.distributed: dist.barrier()
+
+    return summary
     
@@ -0,0 +1,44 @@
+import os
+import json
+import torch
+import warnings
+from torch.utils.data import DataLoader
+
+from options import get_options
+from problems.problem_pdtsp import PDTSP
+from agent.ppo import PPO
+from nets.onnx_export import export_actor
+from agent.onnx_runner import OnnxInserter, compare_with_rollout
+from utils.utils import get_inner_model
+
+
+if __name__ == "__main__":
+
+    warnings.filterwarnings("ignore")
+    os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+    opts = get_options()
+    opts.eval_only = True
+    opts.device = torch.device("cpu")
+    # the runner decodes greedily, the rollout it is checked against has to as well
+    assert opts.val_m == 1 and opts.beam_width == 1 and opts.rescore_k == 1 and opts.deadline_ms is None, \
+        'the onnx runner only supports the plain greedy rollout'
+
+    problem = PDTSP(p_size = opts.graph_size, sta_orders = opts.sta_orders, with_assert = opts.use_assert)
+    agent = PPO(problem.NAME, problem.size, opts)
+    if opts.load_path is not None:
+        agent.load(opts.load_path)
+
+    dirname = os.path.dirname(opts.onnx_path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    for path in export_actor(get_inner_model(agent.actor), opts.onnx_path, problem.size + 1):
+        print('Exported', path)
+
+    # check the runner against PPO.rollout on the validation set
+    if opts.val_dataset is not None:
+        val_dataset = problem.make_dataset(filename=opts.val_dataset, size=opts.graph_size,
+                                           num_samples=opts.val_size, flag_val=True)
+        val_dataloader = DataLoader(val_dataset, batch_size=opts.val_batch_size, shuffle=False, num_workers=0)
+        report = compare_with_rollout(agent, problem, OnnxInserter(opts.onnx_path), val_dataloader)
+        print(json.dumps(report, indent=True))
@@ -0,0 +1,51 @@
+import json
+import time
+import argparse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from problems.problem_pdtsp import PDTSP
+from agent.server import ServerMetrics
+
+
+def post(url, payload):
+    request = urllib.request.Request(url, data = json.dumps(payload).encode(),
+                                     headers = {'Content-Type': 'application/json'})
+    s_time = time.perf_counter()
+    with urllib.request.urlopen(request) as response:
+        result = json.loads(response.read())
+    return result, time.perf_counter() - s_time
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Load generator for the insertion server")
+    parser.add_argument('--url', default='http://127.0.0.1:8765', help='address of the insertion server')
+    parser.add_argument('--dataset', default='./datasets/pdp_7_3_val.pkl', help='instances sent as requests')
+    parser.add_argument('--graph_size', type=int, default=20, help='the number of customers in the instances')
+    parser.add_argument('--n_requests', type=int, default=1000, help='total number of requests')
+    parser.add_argument('--concurrency', type=int, default=16, help='number of concurrent clients')
+    args = parser.parse_args()
+
+    dataset = PDTSP.make_dataset(filename = args.dataset, size = args.graph_size, num_samples = args.n_requests, flag_val = True)
+    payloads = [{'coordinates': dataset[i % len(dataset)]['coordinates'].tolist(),
+                 'route': dataset[i % len(dataset)]['sol_static'].tolist(),
+                 'dynamic_loc': dataset[i % len(dataset)]['dynamic_loc'].tolist()} for i in range(args.n_requests)]
+
+    s_time = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        results = list(pool.map(lambda payload: post(args.url + '/insert', payload), payloads))
+    time_used = time.perf_counter() - s_time
+
+    latency = [t for _, t in results]
+    batch_size = [result['batch_size'] for result, _ in results]
+    print('-' * 60)
+    print('Requests:'.center(35), '{}'.format(len(results)))
+    print('Throughput (req/s):'.center(35), '{:f}'.format(len(results) / time_used))
+    print('Client latency (s):'.center(35), json.dumps(ServerMetrics.describe(latency)))
+    print('Avg batch size:'.center(35), '{:f}'.format(np.mean(batch_size)))
+    print('-' * 60)
+    with urllib.request.urlopen(args.url + '/metrics') as response:
+        print(json.dumps(json.loads(response.read()), indent = True))
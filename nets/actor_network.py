@@ -1,5 +1,6 @@
 from torch import nn
 import torch
+from torch.utils.checkpoint import checkpoint
 from nets.graph_layers import AttentionEncoder_1, MultiHeadEncoder, MultiHeadDecoder, EmbeddingNet, MultiHeadPosCompat
 
 class mySequential(nn.Sequential):
@@ -16,6 +17,61 @@ def get_action_sig(action_record):
     return torch.cat((action_record_tensor[-3:].transpose(0,1),
       action_record_tensor.mean(0).unsqueeze(1)),1)
     
+class CompiledEncoder:
+    # Actor.encode compiled with torch.compile once per (batch bucket, graph size) for inference;
+    # batches are padded up to the smallest bucket that fits, a shape is compiled the first time it is seen
+    # (or by warmup), batches larger than every bucket and training (grad enabled) run eagerly
+    def __init__(self, actor, buckets):
+        self.actor = actor
+        self.buckets = sorted(buckets)
+        self.compiled = None
+        # shapes seen so far, a new one triggers a compilation
+        self.shapes = set()
+        self.n_compiles = 0
+
+    def __getstate__(self):
+        # compiled code is not picklable, worker processes recompile their own
+        return {**self.__dict__, 'compiled': None, 'shapes': set()}
+
+    def get_bucket(self, bs):
+        for bucket in self.buckets:
+            if bucket >= bs:
+                return bucket
+        return None
+
+    def warmup(self, graph_size):
+        device = next(self.actor.parameters()).device
+        training = self.actor.training
+        self.actor.eval()
+        # no_grad (rollout) and inference_mode (Inserter) tensors are guarded separately
+        for mode in (torch.no_grad, torch.inference_mode):
+            with mode():
+                for bucket in self.buckets:
+                    self(torch.rand(bucket, graph_size, self.actor.node_dim, device = device),
+                         torch.arange(graph_size, device = device).repeat(bucket, 1))
+        self.actor.train(training)
+
+    def __call__(self, x_in, index_for_freqs):
+        bs, gs, _ = x_in.size()
+        bucket = self.get_bucket(bs)
+        if bucket is None or self.actor.training or torch.is_grad_enabled():
+            return self.actor.encode(x_in, index_for_freqs)
+        if self.compiled is None:
+            # one entry per (bucket, graph size, grad mode) in the dynamo cache
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 8 * len(self.buckets))
+            self.compiled = torch.compile(self.actor.encode, dynamic = False)
+        shape = (bucket, gs, torch.is_inference_mode_enabled())
+        if shape not in self.shapes:
+            self.shapes.add(shape)
+            self.n_compiles += 1
+        if bucket > bs:
+            # pad with copies of the last instance, instances do not interact in the encoder
+            pad = bucket - bs
+            x_in = torch.cat((x_in, x_in[-1:].expand(pad, -1, -1)))
+            index_for_freqs = torch.cat((index_for_freqs, index_for_freqs[-1:].expand(pad, -1)))
+        return self.compiled(x_in, index_for_freqs)[:bs]
+
+
 class Actor(nn.Module):
 
     def __init__(self,
@@ -27,6 +83,9 @@ class Actor(nn.Module):
                  normalization,
                  v_range,
                  seq_length,
+                 rescore_k = 1,
+                 precision = 'fp32',
+                 checkpoint_activations = False,
                  ):
         super(Actor, self).__init__()
         
@@ -39,6 +98,8 @@ class Actor(nn.Module):
         self.seq_length = seq_length        
         self.clac_stacks = problem_name == 'pdtspl'
         self.node_dim = 2
+        self.precision = precision
+        self.checkpoint_activations = checkpoint_activations
 
         # networks
         self.embedder = EmbeddingNet(
@@ -69,8 +130,13 @@ class Actor(nn.Module):
         
         self.decoder = MultiHeadDecoder(input_dim = self.embedding_dim, 
                                         embed_dim = self.embedding_dim,
-                                        v_range = self.range) # the two propsoed decoders
+                                        v_range = self.range,
+                                        rescore_k = rescore_k,
+                                        checkpoint_activations = checkpoint_activations) # the two propsoed decoders
         
+        # eager until enable_compile is called
+        self.compiled_encode = self.encode
+
         print(self.get_parameter_number())
 
     def get_parameter_number(self):
@@ -78,14 +144,45 @@ class Actor(nn.Module):
         trainable_num = sum(p.numel() for p in self.parameters() if p.requires_grad)
         return {'Total': total_num, 'Trainable': trainable_num}
 
-    def forward(self, problem, x_in, solution, action_his, step_info, epsilon_info = None, do_sample = False, fixed_action = None, require_entropy = False, to_critic = False, only_critic  = False):
+    def encode(self, x_in, index_for_freqs):
+        # node embeddings with the RoPE positions of the current routes, the part compiled by enable_compile
+        freqs_cis = self.embedder.precompute_freqs_cis(self.embedding_dim, index_for_freqs)
+        h_em = self.embedder.embedder(x_in)
+        if self.checkpoint_activations and torch.is_grad_enabled():
+            # keep only the input of every layer, its activations are recomputed in backward
+            for layer in self.encoder:
+                h_em = checkpoint(layer, h_em, freqs_cis, use_reentrant = False)[0]
+            return h_em
+        return self.encoder(h_em, freqs_cis)[0]
+
+    def autocast(self, x):
+        # bf16 autocast of the matmuls, the masked softmaxes (decoder tables) and the normalization stay in fp32
+        return torch.autocast(x.device.type, dtype = torch.bfloat16, enabled = self.precision == 'bf16')
+
+    def enable_compile(self, buckets, graph_sizes = ()):
+        # compiled inference encoder, the buckets of graph_sizes are compiled (pre-warmed) right away
+        self.compiled_encode = CompiledEncoder(self, buckets)
+        for gs in graph_sizes:
+            self.compiled_encode.warmup(gs)
+
+    def propose(self, problem, x_in, solution, action_his, step_info, n_removal, n_reinsertion):
+        # encode the states and return the top candidate actions of both heads, see MultiHeadDecoder.propose
+        index_for_freqs, visited_time = self.embedder.get_visited_time(solution, step_info)
+        visited_order_map = problem.get_visited_order_map(visited_time, step_info)
+        with self.autocast(x_in):
+            h_em = self.compiled_encode(x_in, index_for_freqs)
+            return self.decoder.propose(problem, h_em, solution, action_his, step_info, visited_order_map,
+                                        n_removal, n_reinsertion)
+
+    def forward(self, problem, x_in, solution, action_his, step_info, epsilon_info = None, do_sample = False, fixed_action = None, require_entropy = False, to_critic = False, only_critic  = False, sample_info = None):
 
         # the embedded input x
         bs, gs, in_d = x_in.size()
-        h_embed, freqs_cis, visited_time = self.embedder(x_in, solution, step_info)
+        index_for_freqs, visited_time = self.embedder.get_visited_time(solution, step_info)
         
         # pass through encoder
-        h_em = self.encoder(h_embed, freqs_cis)[0]
+        with self.autocast(x_in):
+            h_em = self.compiled_encode(x_in, index_for_freqs)
        # h_em = self.encoder_l2n(h_em)
 
         
@@ -96,19 +193,21 @@ class Actor(nn.Module):
         del visited_time
         
         # pass through decoder
-        action, log_ll, entropy, CI_action = self.decoder(problem,
-                                                h_em, 
-                                                solution,
-                                                action_his,
-                                                step_info,
-                                                x_in,
-                                                visited_order_map,
-                                                epsilon_info,
-                                                fixed_action,
-                                                require_entropy = require_entropy,
-                                                do_sample = do_sample)
+        with self.autocast(x_in):
+            action, log_ll, entropy, CI_action = self.decoder(problem,
+                                                    h_em, 
+                                                    solution,
+                                                    action_his,
+                                                    step_info,
+                                                    x_in,
+                                                    visited_order_map,
+                                                    epsilon_info,
+                                                    fixed_action,
+                                                    require_entropy = require_entropy,
+                                                    do_sample = do_sample,
+                                                    sample_info = sample_info)
 
         if require_entropy:
-            return action, log_ll.squeeze(), (h_em) if to_critic else None, entropy, CI_action
+            return action, log_ll.squeeze(-1), (h_em) if to_critic else None, entropy, CI_action
         else:
-            return action, log_ll.squeeze(), (h_em) if to_critic else None, CI_action
+            return action, log_ll.squeeze(-1), (h_em) if to_critic else None, CI_action
@@ -1,3 +1,4 @@
+import torch
 from torch import nn
 from nets.graph_layers import  MultiHeadAttentionLayerforCritic, ValueDecoder
 
@@ -11,6 +12,7 @@ class Critic(nn.Module):
              n_heads,
              n_layers,
              normalization,
+             precision = 'fp32',
              ):
         
         super(Critic, self).__init__()
@@ -19,6 +21,7 @@ class Critic(nn.Module):
         self.n_heads = n_heads
         self.n_layers = n_layers
         self.normalization = normalization
+        self.precision = precision
         self.encoder = nn.Sequential(*(
             MultiHeadAttentionLayerforCritic(self.n_heads, 
                                     self.embedding_dim, 
@@ -33,9 +36,11 @@ class Critic(nn.Module):
         
     def forward(self, input, cost):
         
-        h_features = input.detach()
-        h_em = self.encoder(h_features)
-        baseline_value = self.value_head(h_em, cost)
+        # bf16 autocast as in the actor, the value is returned in fp32
+        with torch.autocast(input.device.type, dtype = torch.bfloat16, enabled = self.precision == 'bf16'):
+            h_features = input.detach()
+            h_em = self.encoder(h_features)
+            baseline_value = self.value_head(h_em, cost).float()
         
-        return baseline_value.detach().squeeze(), baseline_value.squeeze()
+        return baseline_value.detach(), baseline_value
         
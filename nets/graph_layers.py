@@ -4,6 +4,7 @@ from torch.distributions import Categorical
 import numpy as np
 from torch import nn
 import math
+from torch.utils.checkpoint import checkpoint
 
 TYPE_REMOVAL = 'N2S'   # Neuro-Ins
 #TYPE_REMOVAL = 'random'
@@ -14,6 +15,13 @@ TYPE_REINSERTION = 'N2S'    # Neuro-Ins
 #TYPE_REINSERTION = 'greedy'
 
 
+def head_matmul(x, weight):
+    # x @ weight for the per-head (n_heads, input_dim, dim) projections, or their int8 replacement (nets/quantization.py)
+    if isinstance(weight, nn.Module):
+        return weight(x)
+    return torch.matmul(x, weight)
+
+
 class SkipConnection(nn.Module):
 
     def __init__(self, module):
@@ -79,15 +87,15 @@ class MultiHeadAttention(nn.Module):
         shp_q = (self.n_heads, batch_size, n_query, -1)
 
         # Calculate queries, (n_heads, n_query, graph_size, key/val_size)
-        Q = torch.matmul(qflat, self.W_query).view(shp_q)
+        Q = head_matmul(qflat, self.W_query).view(shp_q)
         # Calculate keys and values (n_heads, batch_size, graph_size, key/val_size)
-        K = torch.matmul(hflat, self.W_key).view(shp)   
-        V = torch.matmul(hflat, self.W_val).view(shp)
+        K = head_matmul(hflat, self.W_key).view(shp)   
+        V = head_matmul(hflat, self.W_val).view(shp)
 
         # Calculate compatibility (n_heads, batch_size, n_query, graph_size)
         compatibility = self.norm_factor * torch.matmul(Q, K.transpose(2, 3))
 
-        attn = F.softmax(compatibility, dim=-1)   
+        attn = F.softmax(compatibility.float(), dim=-1)   
        
         heads = torch.matmul(attn, V)
 
@@ -152,6 +160,13 @@ class MultiHeadAttentionNew(nn.Module):
         xq_ = xq.float().reshape(*xq.shape[:-1], -1, 2)
         xk_ = xk.float().reshape(*xk.shape[:-1], -1, 2)
 
+        if not freqs_cis.is_complex():
+            # real (cos, sin) pairs from EmbeddingNet.precompute_freqs_real, the same rotation without complex tensors
+            cos, sin = freqs_cis.unbind(-1)
+            xq_out = torch.stack((xq_[..., 0] * cos - xq_[..., 1] * sin, xq_[..., 0] * sin + xq_[..., 1] * cos), -1).flatten(2)
+            xk_out = torch.stack((xk_[..., 0] * cos - xk_[..., 1] * sin, xk_[..., 0] * sin + xk_[..., 1] * cos), -1).flatten(2)
+            return xq_out.type_as(xq), xk_out.type_as(xk)
+
         # 转为复数域
         xq_ = torch.view_as_complex(xq_)
         xk_ = torch.view_as_complex(xk_)
@@ -173,9 +188,9 @@ class MultiHeadAttentionNew(nn.Module):
         shp = (batch_size, graph_size, -1)
 
         # Calculate queries, (n_heads, n_query, graph_size, key/val_size)
-        Q = torch.matmul(hflat, self.W_query).view(shp)
-        K = torch.matmul(hflat, self.W_key).view(shp)   
-        V = torch.matmul(hflat, self.W_val).view(shp)
+        Q = head_matmul(hflat, self.W_query).view(shp)
+        K = head_matmul(hflat, self.W_key).view(shp)   
+        V = head_matmul(hflat, self.W_val).view(shp)
 
         # attention 操作之前，应用旋转位置编码
         Q, K = self.apply_rotary_emb(Q, K, out_source_attn)
@@ -230,8 +245,8 @@ class MultiHeadPosCompat(nn.Module):
         shp = (self.n_heads, batch_size, graph_size, -1)
 
         # Calculate queries, (n_heads, n_query, graph_size, key/val_size)
-        Q = torch.matmul(posflat, self.W_query).view(shp)  
-        K = torch.matmul(posflat, self.W_key).view(shp)   
+        Q = head_matmul(posflat, self.W_query).view(shp)  
+        K = head_matmul(posflat, self.W_key).view(shp)   
 
         # Calculate compatibility (n_heads, batch_size, n_query, graph_size)
         return torch.matmul(Q, K.transpose(2, 3))
@@ -295,8 +310,8 @@ class MultiHeadCompat(nn.Module):
         shp_q = (self.n_heads, batch_size, n_query, -1)
 
         # Calculate queries, (n_heads, n_query, graph_size, key/val_size)
-        Q = torch.matmul(qflat, self.W_query).view(shp_q)  
-        K = torch.matmul(hflat, self.W_key).view(shp)   
+        Q = head_matmul(qflat, self.W_query).view(shp_q)  
+        K = head_matmul(hflat, self.W_key).view(shp)   
 
         # Calculate compatibility (n_heads, batch_size, n_query, graph_size)
         compatibility_s2n = torch.matmul(Q, K.transpose(2, 3))
@@ -324,7 +339,7 @@ class LinearSelect(nn.Module):
 
     def forward(self, h):
 
-        compatibility_pairing = self.proj(h).squeeze()
+        compatibility_pairing = self.proj(h).squeeze(-1)
         
         return  compatibility_pairing
 
@@ -390,11 +405,9 @@ class Reinsertion(nn.Module):
         h_K_neibour = h.gather(1, rec.view(batch_size, graph_size, 1).expand_as(h))
 
         # not return to the depot START
-        mask_last_node = (rec == 0).unsqueeze(-1).expand_as(h_K_neibour)
-        h_K_neibour_P = h_K_neibour.clone()
-        h_K_neibour_D = h_K_neibour.clone()
-        h_K_neibour_P[mask_last_node] = h_pickup.clone().expand_as(h_K_neibour)[mask_last_node]
-        h_K_neibour_D[mask_last_node] = h_delivery.clone().expand_as(h_K_neibour)[mask_last_node]
+        mask_last_node = (rec == 0).unsqueeze(-1)
+        h_K_neibour_P = torch.where(mask_last_node, h_pickup, h_K_neibour)
+        h_K_neibour_D = torch.where(mask_last_node, h_delivery, h_K_neibour)
         # not return to the depot END
 
         compatibility_pickup_pre = self.compater_insert1(h_pickup, h).permute(1,2,3,0).view(shp_p).expand(shp)
@@ -404,7 +417,7 @@ class Reinsertion(nn.Module):
 
 
         # p and d insert after the same node
-        diag_indices = torch.arange(graph_size)
+        same_node = torch.eye(graph_size, dtype = torch.bool, device = h.device)
 
         compatibility_pickup_post_delivery = self.compater_insert2(h_pickup, h_delivery).permute(1, 2, 3, 0).view(shp_p).expand(shp)
         #compatibility_delivery_pre_pickup = self.compater_insert1(h_delivery, h_pickup).permute(1, 2, 3, 0).view(shp_d).expand(shp)
@@ -413,17 +426,15 @@ class Reinsertion(nn.Module):
         compatibility_same_node = self.agg(torch.cat((compatibility_pickup_pre,
                                             compatibility_pickup_post_delivery,
                                             compatibility_delivery_pre_pickup,
-                                            compatibility_delivery_post),-1)).squeeze()
+                                            compatibility_delivery_post),-1))
 
 
         compatibility = self.agg(torch.cat((compatibility_pickup_pre, 
                                             compatibility_pickup_post, 
                                             compatibility_delivery_pre, 
-                                            compatibility_delivery_post),-1)).squeeze()
+                                            compatibility_delivery_post),-1))
 
-        compatibility[:, diag_indices, diag_indices] = compatibility_same_node[:, diag_indices, diag_indices]
-
-        return compatibility
+        return torch.where(same_node, compatibility_same_node, compatibility)
 
 class MLP(torch.nn.Module):
     def __init__(self,
@@ -495,6 +506,23 @@ class ValueDecoder(nn.Module):
 
 
 
+def sample_copies(log_probs, n_copies, distinct = False):
+    # the batch holds n_copies copies of every instance (copy-major), copy 0 takes the argmax and the others a
+    # Gumbel-max sample; with distinct (identical copies) they are drawn without replacement (Gumbel-top-k)
+    bs = log_probs.size(0) // n_copies
+    greedy = log_probs.max(-1)[1]
+    perturbed = log_probs - torch.log(-torch.log(torch.rand_like(log_probs).clamp_min(1e-20)))
+    if distinct:
+        perturbed = perturbed[:bs].scatter(1, greedy[:bs].unsqueeze(1), float('inf'))
+        index = perturbed.topk(n_copies, dim = -1)[1].t().reshape(-1)
+    else:
+        index = perturbed.max(-1)[1]
+        index[:bs] = greedy[:bs]
+    # never leave the feasible set when there are fewer feasible actions than copies
+    index = torch.where(log_probs.gather(1, index.unsqueeze(1)).view(-1) > -1e10, index, greedy)
+    return index.unsqueeze(1)
+
+
 class MultiHeadDecoder(nn.Module):
     def __init__(
             self,
@@ -503,12 +531,16 @@ class MultiHeadDecoder(nn.Module):
             val_dim=None,
             key_dim=None,
             v_range = 6,
+            rescore_k = 1,
+            checkpoint_activations = False,
     ):
         super(MultiHeadDecoder, self).__init__()
         self.n_heads = n_heads = 1
         self.embed_dim = embed_dim
         self.input_dim = input_dim        
         self.range = v_range
+        self.rescore_k = rescore_k
+        self.checkpoint_activations = checkpoint_activations
         
         if TYPE_REMOVAL == 'N2S':
             self.select_order = LinearSelect(embed_dim)
@@ -529,7 +561,59 @@ class MultiHeadDecoder(nn.Module):
             param.data.uniform_(-stdv, stdv)
         
         
-    def forward(self, problem, h_em, solutions, action_his, step_info, x_in, visited_order_map, epsilon_info = None, fixed_action = None, require_entropy = False, do_sample = True):
+    def get_removal_table(self, h, solutions, dy_size):
+        # logits of selecting each un-inserted dynamic pickup, bs, gs
+        bs, gs, _ = h.size()
+        # logits in fp32 under bf16 autocast, they are masked with -1e20 and go through softmax
+        action_removal_table = torch.tanh(self.select_order(h).float()) * self.range
+
+        # mask the other nodes apart from candidates
+        dy_delivery = int(gs - dy_size + dy_size / 2)
+
+        action_removal_table[:, :int(gs - dy_size)] = -1e20
+        action_removal_table[:, dy_delivery:] = -1e20
+        action_removal_table[solutions != 0] = -1e20
+        return action_removal_table
+
+    def get_reinsertion_table(self, h, pos_pickup, pos_delivery, solutions, mask_table):
+        # logits of inserting the pickup after node i and the delivery after node j, bs, gs, gs (masked pairs not applied)
+        if self.checkpoint_activations and torch.is_grad_enabled():
+            # the bs * gs * gs inputs and hidden layers of the aggregation MLP are recomputed in backward
+            table = checkpoint(self.compater_reinsertion, h, pos_pickup, pos_delivery, solutions, mask_table, use_reentrant = False)
+        else:
+            table = self.compater_reinsertion(h, pos_pickup, pos_delivery, solutions, mask_table)
+        return torch.tanh(table.float()) * self.range
+
+    def propose(self, problem, h_em, solutions, action_his, step_info, visited_order_map, n_removal, n_reinsertion):
+        # top candidates of both heads without committing any: the n_removal most probable orders, each with its
+        # n_reinsertion most probable pairs; returns the actions (bs, C, 3), their joint log-probs and validity (bs, C)
+        dy_size, dy_t = step_info
+        bs, gs, dim = h_em.size()
+        dy_half_pos = dy_size // 2
+
+        log_p_removal = F.log_softmax(self.get_removal_table(h_em, solutions, dy_size), dim = -1)
+        n_removal = max(1, min(n_removal, dy_half_pos - dy_t))
+        log_p_removal, action_removal = log_p_removal.topk(n_removal, dim = -1)
+        action_removal = action_removal.reshape(-1, 1)
+
+        # one state per (instance, order)
+        h_r = h_em.repeat_interleave(n_removal, 0)
+        solutions_r = solutions.repeat_interleave(n_removal, 0)
+        action_his_r = action_his.repeat_interleave(n_removal, 0)
+        action_his_r.scatter_(1, action_removal, True)
+        action_his_r.scatter_(1, action_removal + dy_half_pos, True)
+        mask_table = problem.get_swap_mask(action_removal, visited_order_map.repeat_interleave(n_removal, 0),
+                                           step_info, action_his_r)
+        pos_pickup = action_removal.view(-1)
+        table = self.get_reinsertion_table(h_r, pos_pickup, pos_pickup + dy_half_pos, solutions_r, mask_table)
+        table[mask_table] = -1e20
+        log_p_reinsertion, pair_index = F.log_softmax(table.view(bs * n_removal, -1), dim = -1).topk(n_reinsertion, dim = -1)
+
+        actions = torch.stack((action_removal.expand(-1, n_reinsertion), pair_index // gs, pair_index % gs), -1)
+        log_p = log_p_removal.view(-1, 1) + log_p_reinsertion
+        return actions.view(bs, -1, 3), log_p.view(bs, -1), log_p.view(bs, -1) > -1e10
+
+    def forward(self, problem, h_em, solutions, action_his, step_info, x_in, visited_order_map, epsilon_info = None, fixed_action = None, require_entropy = False, do_sample = True, sample_info = None):
         # size info
         dy_size, dy_t = step_info
 
@@ -546,17 +630,7 @@ class MultiHeadDecoder(nn.Module):
 
         ############# action1 select a dynamic order
         if TYPE_REMOVAL == 'N2S':
-            action_removal_table = torch.tanh(self.select_order(h).squeeze()) * self.range
-
-            # mask the other nodes apart from candidates
-            dy_delivery = int(gs - dy_size + dy_size / 2)
-
-            action_removal_table[arange, :int(gs - dy_size)] = -1e20
-            action_removal_table[arange, dy_delivery:] = -1e20
-
-            mask_selected = torch.zeros_like(action_removal_table, dtype=torch.bool, device=action_removal_table.device)
-            mask_selected[solutions != 0] = True
-            action_removal_table[mask_selected] = -1e20
+            action_removal_table = self.get_removal_table(h, solutions, dy_size)
 
             log_ll_removal = F.log_softmax(action_removal_table, dim = -1) if self.training and TYPE_REMOVAL == 'N2S' else None
             probs_removal = F.softmax(action_removal_table, dim = -1)
@@ -570,6 +644,11 @@ class MultiHeadDecoder(nn.Module):
         else:
             if TYPE_REMOVAL == 'random':
                 action_removal = torch.full((bs, 1), fill_value=dy_pos, dtype=torch.long).to(h_em.device)
+            elif sample_info is not None:
+                # identical copies share the greedy order so that their distinct insertions are comparable
+                n_copies, distinct = sample_info
+                action_removal = sample_copies(torch.log(probs_removal), n_copies) if not distinct \
+                                    else probs_removal.max(-1)[1].unsqueeze(1)
             else:
                 if do_sample:
                     action_removal = probs_removal.multinomial(1)
@@ -588,7 +667,7 @@ class MultiHeadDecoder(nn.Module):
         pos_delivery = pos_pickup + dy_half_pos
         mask_table = problem.get_swap_mask(action_removal, visited_order_map, step_info, action_his).expand(bs, gs, gs).cpu()
         if TYPE_REINSERTION == 'N2S':
-            action_reinsertion_table = torch.tanh(self.compater_reinsertion(h, pos_pickup, pos_delivery, solutions, mask_table)) * self.range
+            action_reinsertion_table = self.get_reinsertion_table(h, pos_pickup, pos_delivery, solutions, mask_table)
         elif TYPE_REINSERTION == 'random':
             action_reinsertion_table = torch.ones(bs, gs, gs).to(h_em.device)
         else:
@@ -626,6 +705,9 @@ class MultiHeadDecoder(nn.Module):
         log_ll_reinsertion = F.log_softmax(action_reinsertion_table, dim = -1) if self.training and TYPE_REINSERTION == 'N2S' else None
         probs_reinsertion = F.softmax(action_reinsertion_table, dim = -1)
 
+        # exact insertion costs of the selected order, used by CI and the rescoring of the top-k proposals
+        insertion_cost = problem.get_insertion_cost_table(x_in, solutions, action_removal)
+
         # fixed action
         if fixed_action is not None:
             p_selected = fixed_action[:,1]
@@ -634,7 +716,15 @@ class MultiHeadDecoder(nn.Module):
             pair_index = pair_index.view(-1,1)
             action = fixed_action
         else:
-            if TYPE_REINSERTION == 'greedy':
+            if sample_info is not None:
+                pair_index = sample_copies(torch.log(probs_reinsertion), *sample_info)
+            elif not do_sample and not self.training and self.rescore_k > 1:
+                # commit the cheapest of the k most probable pairs
+                topk_index = probs_reinsertion.topk(min(self.rescore_k, gs * gs), dim = -1)[1]
+                topk_cost = insertion_cost.view(bs, -1).gather(1, topk_index)
+                topk_cost[mask_table.view(bs, -1).to(topk_index.device).gather(1, topk_index)] = float('inf')
+                pair_index = topk_index.gather(1, topk_cost.min(-1)[1].unsqueeze(1))
+            elif TYPE_REINSERTION == 'greedy':
                 action_reinsertion_random = probs_reinsertion_random.multinomial(1)
                 action_reinsertion_greedy = probs_reinsertion.max(-1)[1].unsqueeze(1)
                 # pair_index = torch.where(torch.rand(bs,1).to(h_em.device) < 0.1, action_reinsertion_random, action_reinsertion_greedy)
@@ -672,31 +762,7 @@ class MultiHeadDecoder(nn.Module):
 
 
         # action of CI
-        pos_pickup = action_removal
-        pos_delivery = pos_pickup + dy_half_pos
-        rec_new = solutions.clone()
-        first_row = torch.arange(gs, device=solutions.device).long().unsqueeze(0).expand(bs, gs)
-        d_i = x_in.gather(1, first_row.unsqueeze(-1).expand(bs, gs, 2))
-        d_i_next = x_in.gather(1, rec_new.long().unsqueeze(-1).expand(bs, gs, 2))
-        d_pick = x_in.gather(1, pos_pickup.unsqueeze(1).expand(bs, gs, 2))
-        d_deli = x_in.gather(1, pos_delivery.unsqueeze(1).expand(bs, gs, 2))
-        cost_insert_p = (d_pick - d_i).norm(p=2, dim=2) + (d_pick - d_i_next).norm(p=2, dim=2) - (d_i - d_i_next).norm(
-            p=2, dim=2)
-        cost_insert_d = (d_deli - d_i).norm(p=2, dim=2) + (d_deli - d_i_next).norm(p=2, dim=2) - (d_i - d_i_next).norm(
-            p=2, dim=2)
-        # not to return depot
-        zero_indices = (solutions == 0).to(torch.bool)
-        cost_insert_p[zero_indices] = (d_pick - d_i).norm(p=2, dim=2)[zero_indices]
-        cost_insert_d[zero_indices] = (d_deli - d_i).norm(p=2, dim=2)[zero_indices]
-        action_reinsertion_table = - (cost_insert_p.view(bs, gs, 1) + cost_insert_d.view(bs, 1, gs))
-        # p and d insert after the same node
-        cost_insert_same_node = -((d_pick - d_i).norm(p=2, dim=2) + (d_pick - d_deli).norm(p=2, dim=2) + \
-                                  (d_deli - d_i_next).norm(p=2, dim=2) - (d_i - d_i_next).norm(p=2, dim=2))
-        cost_insert_same_node[zero_indices] = (-(d_pick - d_i).norm(p=2, dim=2) - (d_pick - d_deli).norm(p=2, dim=2))[
-            zero_indices]
-        action_reinsertion_table.diagonal(dim1=-2, dim2=-1).zero_()
-        diagonal_matrix = torch.diag_embed(cost_insert_same_node)
-        action_reinsertion_table += diagonal_matrix
+        action_reinsertion_table = - insertion_cost
         action_reinsertion_table[mask_table] = -1e20
         action_reinsertion_table = action_reinsertion_table.view(bs, -1)
         probs_reinsertion = F.softmax(action_reinsertion_table, dim = -1)
@@ -737,7 +803,9 @@ class Normalization(nn.Module):
 
     def forward(self, input):
         if self.normalization == 'layer':
-            return (input - input.mean((1,2)).view(-1,1,1)) / torch.sqrt(input.var((1,2)).view(-1,1,1) + 1e-05)
+            # statistics in fp32 under bf16 autocast
+            x = input.float()
+            return ((x - x.mean((1,2)).view(-1,1,1)) / torch.sqrt(x.var((1,2)).view(-1,1,1) + 1e-05)).type_as(input)
 
         if isinstance(self.normalizer, nn.BatchNorm1d):
             return self.normalizer(input.view(-1, input.size(-1))).view(*input.size())
@@ -912,7 +980,8 @@ class EmbeddingNet(nn.Module):
             param.data.uniform_(-stdv, stdv)
 
 
-    def get_visited_time(self, solutions, step_info):
+    @staticmethod
+    def get_visited_time(solutions, step_info):
         # size info
         dy_size, dy_t = step_info
         batch_size, seq_length = solutions.size()
@@ -928,6 +997,22 @@ class EmbeddingNet(nn.Module):
 
         arange = torch.arange(batch_size)
 
+        if torch.is_tensor(dy_t):
+            # per-sample step info (batched re-evaluation of several timesteps):
+            # stop updating a sample once its (shorter) route has been traversed
+            valid_seq_length = valid_seq_length.to(solutions.device)
+            for i in range(int(valid_seq_length.max())):
+
+                # calculate visited_time
+                current_nodes = solutions[arange, pre]
+                visited_time[arange, current_nodes] = torch.where(i < valid_seq_length,
+                                                                  visited_time.new_tensor(i + 1),
+                                                                  visited_time[arange, current_nodes])
+                pre = current_nodes
+
+            index = (visited_time % valid_seq_length.view(-1, 1)).long()
+            return index, visited_time.long()
+
         for i in range(valid_seq_length):
 
             # calculate visited_time
@@ -954,6 +1039,12 @@ class EmbeddingNet(nn.Module):
         # then freqs_cis = [cos(x) + sin(x)i, cos(y) + sin(y)i]
         freqs_cis = torch.polar(torch.ones_like(freqs), freqs)
         return freqs_cis
+
+    def precompute_freqs_real(self, dim: int, index, theta: float = 10000.0):
+        # the rotations of precompute_freqs_cis as real (cos, sin) pairs, bs, gs, dim // 2, 2 (ONNX has no complex dtype)
+        freqs = 1.0 / (theta ** (torch.arange(0, dim, 2, device=index.device)[: (dim // 2)].float() / dim))
+        freqs = index.to(torch.float).unsqueeze(-1) * freqs
+        return torch.stack((freqs.cos(), freqs.sin()), -1)
         
     def forward(self, x, solutions, step_info):
         index_for_freqs, visited_time = self.get_visited_time(solutions, step_info)
@@ -0,0 +1,80 @@
+import torch
+from torch import nn
+
+
+class EncoderRemovalGraph(nn.Module):
+    # embedder, encoder and removal head of the actor as one graph
+    # x_in: bs, gs, 2; index: bs, gs (RoPE positions from EmbeddingNet.get_visited_time); removal_mask: bs, gs
+    # returns the node embeddings (bs, gs, dim) and the masked removal logits (bs, gs)
+    def __init__(self, actor):
+        super(EncoderRemovalGraph, self).__init__()
+        self.actor = actor
+
+    def forward(self, x_in, index, removal_mask):
+        actor = self.actor
+        freqs = actor.embedder.precompute_freqs_real(actor.embedding_dim, index)
+        h_em = actor.encoder(actor.embedder.embedder(x_in), freqs)[0]
+        logits = torch.tanh(actor.decoder.select_order(h_em)) * actor.decoder.range
+        return h_em, logits.masked_fill(removal_mask, -1e20)
+
+
+class ReinsertionGraph(nn.Module):
+    # reinsertion head of the actor for the selected orders
+    # h_em: bs, gs, dim; pos_pickup, pos_delivery: bs; rec: bs, gs; mask_table: bs, gs, gs (PDTSP.get_swap_mask)
+    # returns the masked logits of the (pickup after i, delivery after j) pairs, bs, gs * gs
+    def __init__(self, actor):
+        super(ReinsertionGraph, self).__init__()
+        self.actor = actor
+
+    def forward(self, h_em, pos_pickup, pos_delivery, rec, mask_table):
+        bs, gs, _ = h_em.size()
+        table = self.actor.decoder.get_reinsertion_table(h_em, pos_pickup, pos_delivery, rec, mask_table)
+        return table.reshape(bs, gs, gs).masked_fill(mask_table, -1e20).reshape(bs, gs * gs)
+
+
+def get_onnx_paths(path):
+    return path + '.encoder.onnx', path + '.reinsertion.onnx'
+
+
+def export_actor(actor, path, graph_size, batch_size = 3, opset_version = 18):
+    '''
+    write the actor to <path>.encoder.onnx and <path>.reinsertion.onnx with dynamic batch and graph-size axes;
+    the route state (visited times, masks, insertions) stays outside the graphs, see agent/onnx_runner.py
+    graph_size: number of nodes (depot included) of the example inputs used for tracing
+    '''
+    actor = actor.to('cpu').eval()
+    gs = graph_size
+    x_in = torch.rand(batch_size, gs, actor.node_dim)
+    index = torch.randperm(gs).repeat(batch_size, 1)
+    removal_mask = torch.rand(batch_size, gs) < 0.5
+    rec = torch.randint(0, gs, (batch_size, gs))
+    pos_pickup = torch.randint(0, gs // 2, (batch_size,))
+    mask_table = torch.rand(batch_size, gs, gs) < 0.5
+
+    encoder_path, reinsertion_path = get_onnx_paths(path)
+    with torch.no_grad():
+        h_em = EncoderRemovalGraph(actor)(x_in, index, removal_mask)[0]
+        torch.onnx.export(EncoderRemovalGraph(actor),
+                          (x_in, index, removal_mask),
+                          encoder_path,
+                          input_names = ['x_in', 'index', 'removal_mask'],
+                          output_names = ['h_em', 'removal_logits'],
+                          dynamic_axes = {'x_in': {0: 'batch', 1: 'nodes'},
+                                          'index': {0: 'batch', 1: 'nodes'},
+                                          'removal_mask': {0: 'batch', 1: 'nodes'},
+                                          'h_em': {0: 'batch', 1: 'nodes'},
+                                          'removal_logits': {0: 'batch', 1: 'nodes'}},
+                          opset_version = opset_version)
+        torch.onnx.export(ReinsertionGraph(actor),
+                          (h_em, pos_pickup, pos_pickup + 1, rec, mask_table),
+                          reinsertion_path,
+                          input_names = ['h_em', 'pos_pickup', 'pos_delivery', 'rec', 'mask_table'],
+                          output_names = ['reinsertion_logits'],
+                          dynamic_axes = {'h_em': {0: 'batch', 1: 'nodes'},
+                                          'pos_pickup': {0: 'batch'},
+                                          'pos_delivery': {0: 'batch'},
+                                          'rec': {0: 'batch', 1: 'nodes'},
+                                          'mask_table': {0: 'batch', 1: 'nodes', 2: 'nodes'},
+                                          'reinsertion_logits': {0: 'batch', 1: 'pairs'}},
+                          opset_version = opset_version)
+    return encoder_path, reinsertion_path
@@ -0,0 +1,54 @@
+import torch
+from torch import nn
+from torch.ao.quantization import quantize_dynamic
+
+# weights of the actor grouped for calibration, groups whose quantization costs too much stay in fp32
+QUANT_GROUPS = ('embedder', 'attention', 'feed_forward', 'removal', 'reinsertion')
+
+
+def get_quant_group(name):
+    # group of a Linear / per-head projection by its qualified name in the actor, None for modules unused in inference
+    if name.startswith('embedder.'):
+        return 'embedder'
+    if name.startswith('encoder.'):
+        return 'attention' if '.MHA.' in name else 'feed_forward'
+    if name.startswith('decoder.select_order'):
+        return 'removal'
+    if name.startswith('decoder.compater_reinsertion'):
+        return 'reinsertion'
+    return None
+
+
+class HeadLinear(nn.Module):
+    # per-head (n_heads, input_dim, dim) projection as one Linear, so that it can be dynamically quantized;
+    # returns torch.matmul(x, weight) for a 2-d x, see head_matmul in nets/graph_layers.py
+    def __init__(self, weight):
+        super(HeadLinear, self).__init__()
+        self.n_heads, input_dim, self.dim = weight.size()
+        self.linear = nn.Linear(input_dim, self.n_heads * self.dim, bias = False)
+        self.linear.weight.data.copy_(weight.detach().permute(0, 2, 1).reshape(-1, input_dim))
+
+    def forward(self, x):
+        out = self.linear(x).view(-1, self.n_heads, self.dim)
+        return out.permute(1, 0, 2).contiguous()
+
+
+def quantize_actor(actor, groups = QUANT_GROUPS, dtype = torch.qint8):
+    '''
+    int8 dynamic quantization (int8 weights, activations quantized on the fly) of the Linear layers and the raw
+    per-head projections of an actor, in place; only CPU inference is supported afterwards
+    groups: the QUANT_GROUPS to quantize, the others are kept in fp32
+    '''
+    actor.eval()
+    for module_name, module in list(actor.named_modules()):
+        for name in ('W_query', 'W_key', 'W_val'):
+            weight = module._parameters.get(name)
+            if weight is not None and get_quant_group('{}.{}'.format(module_name, name)) in groups:
+                del module._parameters[name]
+                setattr(module, name, HeadLinear(weight))
+
+    targets = {name for name, module in actor.named_modules()
+               if isinstance(module, nn.Linear) and get_quant_group(name) in groups}
+    if targets:
+        quantize_dynamic(actor, targets, dtype = dtype, inplace = True)
+    return actor
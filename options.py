@@ -3,6 +3,8 @@ import time
 import argparse
 import torch
 
+from nets.quantization import QUANT_GROUPS
+
 
 def get_options(args=None):
     parser = argparse.ArgumentParser(description="Neural Neighborhood Search")
@@ -17,6 +19,11 @@ def get_options(args=None):
     parser.add_argument('--no_saving', action='store_true', help='disable saving checkpoints')
     parser.add_argument('--use_assert', action='store_true', help='enable assertion')
     parser.add_argument('--no_DDP', action='store_true', help='disable distributed parallel')
+    parser.add_argument('--world_size', type=int, default=None, help='total number of distributed processes, default the number of GPUs')
+    parser.add_argument('--dist_backend', default='nccl', choices = ['nccl', 'gloo'], help="distributed backend, 'gloo' runs the ranks on CPU")
+    parser.add_argument('--nnodes', type=int, default=1, help='number of nodes taking part in distributed training')
+    parser.add_argument('--node_rank', type=int, default=0, help='rank of this node in distributed training')
+    parser.add_argument('--n_rollout_workers', type=int, default=0, help='number of CPU rollout worker processes feeding the PPO learner, 0 to roll out in the learner')
     parser.add_argument('--seed', type=int, default=1234, help='random seed to use')
 
 
@@ -30,12 +37,21 @@ def get_options(args=None):
     parser.add_argument('--hidden_dim', type=int, default=128, help='dimension of hidden layers in Enc/Dec')
     parser.add_argument('--n_encode_layers', type=int, default=3, help='number of stacked layers in the encoder')
     parser.add_argument('--normalization', default='layer', help="normalization type, 'layer' (default) or 'batch'")
+    parser.add_argument('--precision', default='fp32', choices=['fp32', 'bf16'], help='bf16 runs the actor and critic under autocast (softmaxes, normalization and costs stay in fp32)')
+    parser.add_argument('--checkpoint_activations', action='store_true', help='recompute the encoder layers and the reinsertion MLP in backward to save memory in the PPO updates (not with batch normalization)')
 
     # Training parameters
     parser.add_argument('--RL_agent', default='ppo', choices = ['ppo', 'Reinforce'], help='RL Training algorithm')
     parser.add_argument('--gamma', type=float, default=0.999, help='reward discount factor for future rewards')
+    parser.add_argument('--gae_lambda', type=float, default=1., help='GAE lambda for the PPO return estimation, 1 uses the Monte-Carlo return')
     parser.add_argument('--K_epochs', type=int, default=10, help='mini PPO epoch')
     parser.add_argument('--eps_clip', type=float, default=0.1, help='PPO clip ratio')
+    parser.add_argument('--ppo_minibatch', type=int, default=0, help='number of (timestep, instance) samples per PPO minibatch, 0 to update on the whole batch')
+    parser.add_argument('--pomo_size', type=int, default=1, help='sampled rollouts per instance for Reinforce, their mean return is the baseline (1: no baseline)')
+    parser.add_argument('--replay_size', type=int, default=0, help='number of recent trajectories (instances) kept for replay in the PPO update, 0 to disable')
+    parser.add_argument('--replay_ratio', type=float, default=1., help='replayed trajectories mixed into each PPO update per fresh trajectory')
+    parser.add_argument('--replay_evict', default='fifo', choices=['fifo', 'random'], help='trajectories replaced once the replay store is full: the oldest or random ones')
+    parser.add_argument('--replay_is_clip', type=float, default=3., help='upper bound of the importance ratios of the replayed trajectories in the PPO loss')
     parser.add_argument('--T_train', type=int, default=250, help='number of itrations for training')
     parser.add_argument('--n_step', type=int, default=5, help='n_step for return estimation')
     parser.add_argument('--warm_up', type=float, default=2, help='hyperparameter of CL scalar $\rho^{CL}$')
@@ -49,6 +65,11 @@ def get_options(args=None):
 
     parser.add_argument('--train_dataset', type=str, default='./datasets/pdp_7_3.pkl',
                         help='dataset file path for training')
+    parser.add_argument('--bc_epochs', type=int, default=0, help='epochs of behaviour cloning of cheapest insertion before the RL epochs')
+    parser.add_argument('--lr_bc', type=float, default=1e-3, help='learning rate of the actor during behaviour cloning')
+    parser.add_argument('--distill_teacher', default=None, help='actor checkpoint to distill into the (smaller) actor configured by the model options, replaces RL training')
+    parser.add_argument('--distill_synthetic', action='store_true', help='distill on freshly sampled uniform instances instead of train_dataset')
+    parser.add_argument('--distill_temperature', type=float, default=1., help='softmax temperature of the teacher and student logits in distillation')
     parser.add_argument('--epsilon', type=float, default=1, help='initial epsilon for e-greedy for action sampling in decoder')
     parser.add_argument('--epsilon_decay', type=float, default=0.01,
                         help='decay rate of epsilon for e-greedy for action sampling in decoder')
@@ -60,8 +81,34 @@ def get_options(args=None):
     parser.add_argument('--val_batch_size', type=int, default=1000, help='Number of instances per batch for validation/inference')
     parser.add_argument('--val_dataset', type=str, default = './datasets/pdp_7_3_val.pkl', help='validate dataset file path')
     parser.add_argument('--val_m', type=int, default=1, help='number of data augments in Algorithm 2')
+    parser.add_argument('--val_aug_mode', default='rotate', choices=['rotate', 'sample', 'both'],
+                        help='val_m copies are rotated instances, sampled decodes (Gumbel-top-k) or rotated sampled decodes')
+    parser.add_argument('--rescore_k', type=int, default=1, help='greedy inference commits the cheapest of the k most probable insertions (1: argmax)')
+    parser.add_argument('--beam_width', type=int, default=1, help='number of partial routes kept per instance by beam search inference (1: greedy rollout)')
+    parser.add_argument('--beam_time_budget', type=float, default=None, help='seconds per batch after which beam search continues greedily')
+    parser.add_argument('--deadline_ms', type=float, default=None, help='per-batch inference budget (ms), steps that would exceed it fall back to cheapest insertion')
+    parser.add_argument('--compile_actor', action='store_true', help='run the inference encoder through torch.compile, one graph per (batch bucket, graph size)')
+    parser.add_argument('--compile_buckets', type=int, nargs='+', default=[1, 8, 32, 128], help='batch sizes the compiled encoder pads batches up to')
+    parser.add_argument('--compile_prewarm', action='store_true', help='compile every bucket for graph_size at startup')
+    parser.add_argument('--quantize', action='store_true', help='int8 dynamic quantization of the actor for CPU inference')
+    parser.add_argument('--quant_groups', nargs='+', default=list(QUANT_GROUPS), choices=QUANT_GROUPS,
+                        help='weight groups of the actor quantized by --quantize (quantize_eval.py calibrates them)')
+    parser.add_argument('--calib_size', type=int, default=100, help='number of instances (after the first val_size) used to calibrate the quantized groups')
+    parser.add_argument('--quant_tolerance', type=float, default=0.1, help='maximum increase (%%) of the mean cost a quantized group may cause in calibration')
+    parser.add_argument('--val_workers', type=int, default=1, help='number of CPU worker processes sharing the validation batches')
+    parser.add_argument('--result_path', default=None, help='binary file the validation routes, objectives and latencies are streamed to')
+    parser.add_argument('--metrics_path', default=None, help='JSON file for the validation metrics summary, default val_metrics.json in the save dir')
+    parser.add_argument('--onnx_path', default='./onnx/actor', help='prefix of the ONNX graphs written by export_onnx.py (<prefix>.encoder.onnx, <prefix>.reinsertion.onnx)')
     
 
+    # insertion server (serve.py)
+    parser.add_argument('--host', default='127.0.0.1', help='address the insertion server listens on')
+    parser.add_argument('--port', type=int, default=8765, help='port of the insertion server')
+    parser.add_argument('--max_batch', type=int, default=32, help='maximum number of requests served by one batched call')
+    parser.add_argument('--cache_size', type=int, default=1024, help='number of insertion results kept in the LRU cache of the Inserter, 0 to disable')
+    parser.add_argument('--cache_decimals', type=int, default=4, help='decimals the coordinates are rounded to when building cache keys')
+    parser.add_argument('--max_wait_ms', type=float, default=5., help='maximum time (ms) the scheduler waits to fill a batch')
+
     # resume and load models
     parser.add_argument('--load_path', default = None, help='path to load model parameters and optimizer state from')
     parser.add_argument('--resume', default = None, help='resume from previous checkpoint file')
@@ -79,12 +126,23 @@ def get_options(args=None):
     opts = parser.parse_args(args)
     
     ### figure out whether to use distributed training
-    opts.world_size = torch.cuda.device_count()
+    if opts.world_size is None:
+        opts.world_size = torch.cuda.device_count()
     opts.distributed = (opts.world_size > 1) and (not opts.no_DDP)
-    os.environ['MASTER_ADDR'] = '127.0.0.1'
-    os.environ['MASTER_PORT'] = '4869'
+    assert opts.world_size % opts.nnodes == 0, 'world_size should be divisible by nnodes'
+    opts.nproc_per_node = opts.world_size // opts.nnodes
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '4869')
     assert opts.val_m <= opts.graph_size // 2
-    opts.use_cuda = torch.cuda.is_available() and not opts.no_cuda
+    opts.use_cuda = torch.cuda.is_available() and not opts.no_cuda and opts.dist_backend != 'gloo'
+    assert not opts.quantize or (not opts.use_cuda and not opts.compile_actor and opts.precision == 'fp32'), \
+        'the quantized actor runs eagerly on CPU in fp32'
+    # the recompute in backward would update the BatchNorm running statistics a second time
+    assert not (opts.checkpoint_activations and opts.normalization == 'batch'), \
+        '--checkpoint_activations does not support --normalization batch'
+    # the workers receive a pickled copy of the agent, whose actor and critic are DDP-wrapped under --distributed
+    assert not (opts.val_workers > 1 and opts.distributed), \
+        '--val_workers > 1 does not support distributed training (use --no_DDP or --val_workers 1)'
     opts.run_name = "{}_{}".format(opts.run_name, time.strftime("%Y%m%dT%H%M%S")) \
         if not opts.resume else opts.resume.split('/')[-2]
     opts.save_dir = os.path.join(
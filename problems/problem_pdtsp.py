@@ -25,6 +25,8 @@ class PDTSP(object):
         dy_size, dy_t = step_info
         bs, gs = visited_time.size()
         valid_l = gs - dy_size + 2 * dy_t
+        if torch.is_tensor(valid_l):
+            valid_l = valid_l.view(-1, 1)
         visited_time = visited_time % valid_l
 
         return visited_time.view(bs, gs, 1) > visited_time.view(bs, 1, gs)
@@ -63,6 +65,13 @@ class PDTSP(object):
         mask[mask_index_un_ins] = True
         return mask
 
+    def get_removal_mask(self, rec):
+        # nodes the removal head may not select: everything but the un-inserted dynamic pickups, bs, gs
+        bs, gs = rec.size()
+        dy_size = self.size - 2 * self.static_orders
+        node = torch.arange(gs, device=rec.device).view(1, -1)
+        return (node < gs - dy_size) | (node >= gs - dy_size // 2) | (rec != 0)
+
     def get_static_solutions(self, batch):
         assert batch['sol_static'].shape[1] == 2 * self.static_orders + 1, "The input (static orders' routes) is wrong..."
         return batch['sol_static'].to(torch.int64)
@@ -196,8 +205,102 @@ class PDTSP(object):
         
         return rec
         
+    def get_insertion_cost_table(self, x_in, rec, selected):
+        # exact cost increase of inserting the order `selected` with its pickup after node i and its delivery after node j
+        # x_in: bs, gs, 2; rec: bs, gs; selected: bs, 1; returns bs, gs, gs
+        bs, gs = rec.size()
+        dy_size = self.size - 2 * self.static_orders
+        pos_pickup = selected
+        pos_delivery = pos_pickup + dy_size // 2
+        first_row = torch.arange(gs, device=rec.device).long().unsqueeze(0).expand(bs, gs)
+        d_i = x_in.gather(1, first_row.unsqueeze(-1).expand(bs, gs, 2))
+        d_i_next = x_in.gather(1, rec.long().unsqueeze(-1).expand(bs, gs, 2))
+        d_pick = x_in.gather(1, pos_pickup.unsqueeze(1).expand(bs, gs, 2))
+        d_deli = x_in.gather(1, pos_delivery.unsqueeze(1).expand(bs, gs, 2))
+        cost_insert_p = (d_pick - d_i).norm(p=2, dim=2) + (d_pick - d_i_next).norm(p=2, dim=2) - (d_i - d_i_next).norm(p=2, dim=2)
+        cost_insert_d = (d_deli - d_i).norm(p=2, dim=2) + (d_deli - d_i_next).norm(p=2, dim=2) - (d_i - d_i_next).norm(p=2, dim=2)
+        # not to return depot
+        zero_indices = (rec == 0).to(torch.bool)
+        cost_insert_p[zero_indices] = (d_pick - d_i).norm(p=2, dim=2)[zero_indices]
+        cost_insert_d[zero_indices] = (d_deli - d_i).norm(p=2, dim=2)[zero_indices]
+        cost_table = cost_insert_p.view(bs, gs, 1) + cost_insert_d.view(bs, 1, gs)
+        # p and d insert after the same node
+        cost_insert_same_node = (d_pick - d_i).norm(p=2, dim=2) + (d_pick - d_deli).norm(p=2, dim=2) + \
+                                (d_deli - d_i_next).norm(p=2, dim=2) - (d_i - d_i_next).norm(p=2, dim=2)
+        cost_insert_same_node[zero_indices] = ((d_pick - d_i).norm(p=2, dim=2) + (d_pick - d_deli).norm(p=2, dim=2))[zero_indices]
+        cost_table.diagonal(dim1=-2, dim2=-1).copy_(cost_insert_same_node)
+        return cost_table
+
+    def get_cheapest_insertion(self, x_in, rec, action_his):
+        # cheapest insertion, needs no model: the un-inserted dynamic order and anchor pair with the smallest
+        # cost increase over all orders, bs, 3
+        bs, gs = rec.size()
+        dy_size = self.size - 2 * self.static_orders
+        n_orders = dy_size // 2
+        pickups = torch.arange(gs - dy_size, gs - n_orders, device=rec.device)
+        cost_table = self.get_insertion_cost_table(x_in.repeat_interleave(n_orders, 0), rec.repeat_interleave(n_orders, 0),
+                                                   pickups.repeat(bs).view(-1, 1)).view(bs, n_orders, gs, gs)
+        # both anchors in the route, the delivery anchor not before the pickup anchor
+        order = self.get_route_order(rec)
+        feasible = (order.view(bs, 1, gs, 1) >= 0) & (order.view(bs, 1, 1, gs) >= order.view(bs, 1, gs, 1))
+        cost_table = cost_table.masked_fill(~feasible, float('inf'))
+        cost_table[action_his[:, pickups]] = float('inf')
+        best = cost_table.view(bs, -1).min(-1)[1]
+        pair_index = best % (gs * gs)
+        selected = pickups[best // (gs * gs)]
+        return torch.stack((selected, pair_index // gs, pair_index % gs), -1)
+
+    def get_route_order(self, rec):
+        # position of every node when walking the route from the depot, -1 for nodes not in the route yet
+        bs, gs = rec.size()
+        arange = torch.arange(bs, device=rec.device)
+        order = torch.full((bs, gs), -1, dtype=torch.long, device=rec.device)
+        order[:, 0] = 0
+        pre = torch.zeros(bs, dtype=torch.long, device=rec.device)
+        finished = torch.zeros(bs, dtype=torch.bool, device=rec.device)
+        for i in range(1, gs):
+            current = rec[arange, pre].long()
+            # the successor of the last node is the padding 0, the walk of that route stops there
+            finished = finished | (current == 0)
+            order[arange, current] = torch.where(finished, order[arange, current], torch.full_like(current, i))
+            pre = current
+        return order
+
+    def score_candidates(self, batch, rec, candidates, return_routes=False):
+        # apply k candidate insertions (selected, first, second) per instance in one batched pass
+        # rec: bs, gs; candidates: bs, k, 3; returns the exact costs (inf if infeasible) and the feasibility, both bs, k
+        bs, gs = rec.size()
+        k = candidates.size(1)
+        dy_size = self.size - 2 * self.static_orders
+        selected, first, second = candidates.long().unbind(-1)
+
+        # feasibility: an un-inserted dynamic pickup, both anchors in the route and the delivery anchor not before the pickup anchor
+        order = self.get_route_order(rec)
+        order_first = order.gather(1, first.clamp(0, gs - 1))
+        order_second = order.gather(1, second.clamp(0, gs - 1))
+        is_pickup = (selected >= gs - dy_size) & (selected < gs - dy_size // 2)
+        un_inserted = rec.gather(1, selected.clamp(0, gs - 1)) == 0
+        in_range = (first >= 0) & (first < gs) & (second >= 0) & (second < gs)
+        feasible = is_pickup & un_inserted & in_range & (order_first >= 0) & (order_second >= order_first)
+
+        # a flattened (bs * k) view of the routes and coordinates, insert_star copies the routes once
+        # (indices are only clamped to stay in range, the routes of infeasible candidates are meaningless)
+        flat_rec = rec.unsqueeze(1).expand(bs, k, gs).reshape(bs * k, gs)
+        next_state = self.insert_star(flat_rec,
+                                      selected.clamp(0, gs - 1 - dy_size // 2).view(-1, 1),
+                                      first.clamp(0, gs - 1).view(-1, 1),
+                                      second.clamp(0, gs - 1).view(-1, 1))
+        flat_batch = {key: batch[key].unsqueeze(1).expand(bs, k, *batch[key].size()[1:]).reshape(bs * k, *batch[key].size()[1:])
+                      for key in ('coordinates', 'dynamic_loc')}
+        costs = self.get_costs(flat_batch, next_state).view(bs, k)
+        costs = torch.where(feasible, costs, torch.full_like(costs, float('inf')))
+
+        if return_routes:
+            return costs, feasible, next_state.view(bs, k, gs)
+        return costs, feasible
+
     def check_feasibility(self, rec):
-        
+
         problem_size = self.size
         static_pos = 2 * self.static_orders
         d_size = problem_size - static_pos
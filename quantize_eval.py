@@ -0,0 +1,83 @@
+import os
+import copy
+import json
+import torch
+import warnings
+from torch.utils.data import DataLoader
+
+from options import get_options
+from problems.problem_pdtsp import PDTSP
+from agent.ppo import PPO
+from nets.quantization import quantize_actor
+from agent.utils import evaluate_agents, with_actor
+from utils.utils import get_inner_model
+
+
+def with_quantized_actor(agent, groups):
+    return with_actor(agent, quantize_actor(copy.deepcopy(get_inner_model(agent.actor)), groups))
+
+
+def calibrate(agent, problem, dataloader, groups, tolerance):
+    # quantize one group at a time, a group is kept if its mean cost increase stays within tolerance (%)
+    # and it does not slow the rollout down (small layers can lose more to quantizing activations than they gain)
+    base, *summaries = evaluate_agents([agent] + [with_quantized_actor(agent, [group]) for group in groups], problem, dataloader)
+    kept, report = [], {}
+    for group, summary in zip(groups, summaries):
+        change = 100 * (summary['final_obj']['mean'] - base['final_obj']['mean']) / base['final_obj']['mean']
+        speedup = base['batch_latency']['mean'] / summary['batch_latency']['mean']
+        report[group] = {'cost_change': change, 'speedup': speedup}
+        if change <= tolerance and speedup >= 1:
+            kept.append(group)
+        print('{:>14}: mean cost {:+.4f}% speedup {:.3f}x{}'.format(
+            group, change, speedup, '' if group in kept else ' (kept in fp32)'))
+    return kept, report
+
+
+if __name__ == "__main__":
+
+    warnings.filterwarnings("ignore")
+    os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+    opts = get_options()
+    opts.eval_only = True
+    opts.device = torch.device("cpu")
+    torch.manual_seed(opts.seed)
+
+    problem = PDTSP(p_size = opts.graph_size, sta_orders = opts.sta_orders, with_assert = opts.use_assert)
+    agent = PPO(problem.NAME, problem.size, opts)
+    if opts.load_path is not None:
+        agent.load(opts.load_path)
+
+    val_dataset = problem.make_dataset(filename=opts.val_dataset, size=opts.graph_size,
+                                       num_samples=opts.val_size, flag_val=True)
+    val_dataloader = DataLoader(val_dataset, batch_size=opts.val_batch_size, shuffle=False, num_workers=0)
+
+    # calibrate on the instances after the evaluated ones (the first ones if the file has no more)
+    groups = opts.quant_groups
+    calib = {}
+    if opts.calib_size > 0:
+        calib_dataset = problem.make_dataset(filename=opts.val_dataset, size=opts.graph_size, num_samples=opts.calib_size,
+                                             offset=opts.val_size, flag_val=True)
+        if len(calib_dataset) == 0:
+            calib_dataset = problem.make_dataset(filename=opts.val_dataset, size=opts.graph_size,
+                                                 num_samples=opts.calib_size, flag_val=True)
+        print('Calibrating the quantized groups on {} instances...'.format(len(calib_dataset)))
+        groups, calib = calibrate(agent, problem, DataLoader(calib_dataset, batch_size=opts.val_batch_size, shuffle=False),
+                                  groups, opts.quant_tolerance)
+
+    fp32, int8 = evaluate_agents([agent, with_quantized_actor(agent, groups)], problem, val_dataloader)
+
+    print('-' * 60)
+    print('Quantized groups:'.center(35), ' '.join(groups) if groups else 'none')
+    for name, key in (('Gap to cheapest insertion', 'gap_ci'), ('Gap to math model', 'gap_mm')):
+        print('{}:'.format(name).center(35), 'fp32 {:.6f} int8 {:.6f} change {:+.6f}'.format(
+            fp32[key]['mean'], int8[key]['mean'], int8[key]['mean'] - fp32[key]['mean']))
+    print('Batch latency (s):'.center(35), 'fp32 {:.6f} int8 {:.6f} speedup {:.3f}x'.format(
+        fp32['batch_latency']['mean'], int8['batch_latency']['mean'],
+        fp32['batch_latency']['mean'] / int8['batch_latency']['mean']))
+    print('-' * 60)
+    print('Use --quantize --quant_groups {}'.format(' '.join(groups) if groups else '(none, keep fp32)'))
+
+    if opts.metrics_path is not None:
+        with open(opts.metrics_path, 'w') as f:
+            json.dump({'quant_groups': groups, 'calibration': calib, 'fp32': fp32, 'int8': int8}, f, indent=True)
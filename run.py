@@ -11,6 +11,8 @@ from problems.problem_pdtsp import PDTSP
 from problems.problem_pdtspl import PDTSPL
 from agent.ppo import PPO
 from agent.Reinforce import Reinforce
+from agent.distill import distill
+from agent.pretrain import pretrain
 
 def load_agent(name):
     agent = {
@@ -83,7 +85,12 @@ def run(opts):
             agent.opts.epoch_start = epoch_resume + 1
     
         # Start the actual training loop
-        agent.start_training(problem, opts.train_dataset, opts.val_dataset, tb_logger)
+        if opts.distill_teacher is not None:
+            distill(problem, agent, opts.train_dataset, opts.val_dataset, tb_logger)
+        else:
+            if opts.bc_epochs > 0 and opts.resume is None:
+                pretrain(problem, agent, opts.train_dataset, opts.val_dataset, tb_logger)
+            agent.start_training(problem, opts.train_dataset, opts.val_dataset, tb_logger)
             
 
 
@@ -0,0 +1,30 @@
+import os
+import torch
+import warnings
+
+from options import get_options
+from agent.inserter import Inserter
+from agent.server import BatchScheduler, make_server
+
+
+if __name__ == "__main__":
+
+    warnings.filterwarnings("ignore")
+    os.environ['KMP_DUPLICATE_LIB_OK']='True'
+
+    opts = get_options()
+    opts.device = torch.device("cuda" if opts.use_cuda else "cpu")
+
+    # load the model once, the scheduler batches the concurrent requests of the http front end
+    inserter = Inserter(opts.load_path, opts)
+    scheduler = BatchScheduler(inserter, max_batch = opts.max_batch, max_wait = opts.max_wait_ms / 1000).start()
+    server = make_server(scheduler, opts.host, opts.port)
+    print('Serving insertions on http://{}:{} (POST /insert, GET /metrics)'.format(opts.host, opts.port), flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        scheduler.stop()
@@ -51,6 +51,47 @@ def log_to_screen_and_file(time_used, count_obj_ci, average_diff_obj_ci, count_o
 
 
     
+def log_metrics_to_screen(summary):
+    # per-instance objective gaps and latency percentiles
+    print('-'*60)
+    for key, name in (('gap_ci', 'Gap to cheapest insertion'), ('gap_mm', 'Gap to math model'),
+                      ('batch_latency', 'Batch latency (s)')):
+        stats = summary[key]
+        if stats['count'] == 0: continue
+        print('{}:'.format(name).center(35), 'mean {:f} p50 {:f} p95 {:f} p99 {:f}'.format(
+            stats['mean'], stats['p50'], stats['p95'], stats['p99']))
+    if summary['fallback_steps'] > 0:
+        print('CI fallback steps (instances):'.center(35), '{} ({})'.format(summary['fallback_steps'], summary['fallback_instances']))
+    print('-'*60, '\n')
+
+
+def log_to_tb_metrics(tb_logger, summary, epoch):
+    for key in ('final_obj', 'gap_ci', 'gap_mm', 'batch_latency'):
+        for stat, value in summary[key].items():
+            if stat != 'count':
+                tb_logger.log_value(f'validation/{key}_{stat}', value, epoch)
+    tb_logger.log_value('validation/fallback_steps', summary['fallback_steps'], epoch)
+
+
+def log_to_tb_distill(tb_logger, agent, kl_removal, kl_reinsertion, grad_norms, mini_step):
+    tb_logger.log_value('learnrate_pg', agent.optimizer.param_groups[0]['lr'], mini_step)
+    tb_logger.log_value('distill/kl_removal', kl_removal, mini_step)
+    tb_logger.log_value('distill/kl_reinsertion', kl_reinsertion, mini_step)
+    grad_norms, grad_norms_clipped = grad_norms
+    tb_logger.log_value('grad/actor', grad_norms[0], mini_step)
+    tb_logger.log_value('grad_clipped/actor', grad_norms_clipped[0], mini_step)
+
+
+def log_to_tb_pretrain(tb_logger, losses, accuracies, grad_norms, mini_step):
+    tb_logger.log_value('pretrain/ce_removal', losses[0], mini_step)
+    tb_logger.log_value('pretrain/ce_reinsertion', losses[1], mini_step)
+    tb_logger.log_value('pretrain/ci_agreement_removal', accuracies[0], mini_step)
+    tb_logger.log_value('pretrain/ci_agreement_reinsertion', accuracies[1], mini_step)
+    grad_norms, grad_norms_clipped = grad_norms
+    tb_logger.log_value('grad/actor', grad_norms[0], mini_step)
+    tb_logger.log_value('grad_clipped/actor', grad_norms_clipped[0], mini_step)
+
+
 def log_to_tb_val(tb_logger, time_used, init_value, best_value, reward, costs_history, search_history,
                   batch_size, val_size, dataset_size, T, epoch):
         
@@ -74,8 +115,8 @@ def log_to_tb_train(tb_logger, agent, Reward, ratios, bl_val_detached, total_cos
     tb_logger.log_value('train/avg_cost', avg_cost, mini_step)
     tb_logger.log_value('train/Target_Returen', Reward.mean().item(), mini_step)
     tb_logger.log_value('train/ratios', ratios.mean().item(), mini_step)
-    avg_reward = torch.stack(reward, 0).sum(0).mean().item()
-    max_reward = torch.stack(reward, 0).max(0)[0].mean().item()
+    avg_reward = reward.sum(0).mean().item()
+    max_reward = reward.max(0)[0].mean().item()
     tb_logger.log_value('train/avg_reward', avg_reward, mini_step)
     tb_logger.log_value('train/init_cost', initial_cost.mean(), mini_step)
     tb_logger.log_value('train/max_reward', max_reward, mini_step)
@@ -93,4 +134,20 @@ def log_to_tb_train(tb_logger, agent, Reward, ratios, bl_val_detached, total_cos
     tb_logger.log_value('loss/total_loss', (reinforce_loss+baseline_loss).item(), mini_step)
     
     tb_logger.log_value('grad/critic', grad_norms[1], mini_step)
-    tb_logger.log_value('grad_clipped/critic', grad_norms_clipped[1], mini_step)
\ No newline at end of file
+    tb_logger.log_value('grad_clipped/critic', grad_norms_clipped[1], mini_step)
+
+
+def log_to_tb_train_reinforce(tb_logger, agent, Reward, baseline, total_cost, grad_norms, reinforce_loss, log_likelihood,
+                              initial_cost, mini_step):
+
+    tb_logger.log_value('learnrate_pg', agent.optimizer.param_groups[0]['lr'], mini_step)
+    tb_logger.log_value('train/avg_cost', total_cost.mean().item(), mini_step)
+    tb_logger.log_value('train/Target_Returen', Reward.mean().item(), mini_step)
+    tb_logger.log_value('train/baseline', baseline.mean().item(), mini_step)
+    tb_logger.log_value('train/advantage_std', (Reward - baseline).std().item(), mini_step)
+    tb_logger.log_value('train/init_cost', initial_cost.mean(), mini_step)
+    grad_norms, grad_norms_clipped = grad_norms
+    tb_logger.log_value('loss/actor_loss', reinforce_loss.item(), mini_step)
+    tb_logger.log_value('loss/nll', -log_likelihood.mean().item(), mini_step)
+    tb_logger.log_value('grad/actor', grad_norms[0], mini_step)
+    tb_logger.log_value('grad_clipped/actor', grad_norms_clipped[0], mini_step)
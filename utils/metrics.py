@@ -0,0 +1,123 @@
+import json
+import math
+import numpy as np
+import torch
+
+
+class Histogram:
+    # fixed-bin streaming histogram: exact count, mean, min and max, percentiles interpolated within a bin;
+    # values below the first or above the last edge fall into two open end bins bounded by min and max
+    def __init__(self, edges):
+        self.edges = edges.double()
+        self.counts = torch.zeros(len(edges) + 1, dtype=torch.float64)
+        self.total = 0.
+        self.min = math.inf
+        self.max = -math.inf
+
+    def add(self, values):
+        values = values.detach().view(-1).cpu().double()
+        if values.numel() == 0:
+            return
+        self.counts += torch.bincount(torch.bucketize(values, self.edges), minlength=self.counts.numel()).double()
+        self.total += float(values.sum())
+        self.min = min(self.min, float(values.min()))
+        self.max = max(self.max, float(values.max()))
+
+    def gather(self, gather_fn):
+        # merge the histograms of all distributed ranks, gather_fn concatenates along the first dimension
+        state = gather_fn(torch.cat((self.counts, torch.tensor([self.total, -self.min, self.max], dtype=torch.float64))).unsqueeze(0))
+        self.counts = state[:, :-3].sum(0)
+        self.total = float(state[:, -3].sum())
+        self.min = -float(state[:, -2].max())
+        self.max = float(state[:, -1].max())
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def percentile(self, q):
+        cum = self.counts.cumsum(0)
+        rank = q / 100 * cum[-1]
+        i = min(int(torch.searchsorted(cum, rank)), self.counts.numel() - 1)
+        lower = float(self.edges[i - 1]) if i > 0 else self.min
+        upper = float(self.edges[i]) if i < len(self.edges) else self.max
+        below = float(cum[i - 1]) if i > 0 else 0.
+        frac = (float(rank) - below) / float(self.counts[i]) if self.counts[i] > 0 else 0.
+        return min(max(lower + frac * (upper - lower), self.min), self.max)
+
+    def describe(self, percentiles):
+        count = len(self)
+        if count == 0:
+            return {'count': 0}
+        out = {'count': count, 'mean': self.total / count}
+        for q in percentiles:
+            out['p{}'.format(q)] = self.percentile(q)
+        return out
+
+
+class MetricsAccumulator:
+    # streaming per-instance / per-batch metrics of an evaluation run, updated batch by batch; the per-instance
+    # values go into fixed-bin histograms (the values themselves are streamed to disk by ResultWriter)
+    PERCENTILES = (50, 95, 99)
+
+    def __init__(self):
+        # objectives on log bins 0.23% apart, gaps on linear bins 1e-4 apart
+        self.final_obj = Histogram(torch.logspace(-3, 4, 7001))
+        self.gap_ci = Histogram(torch.linspace(-1, 3, 40001))
+        self.gap_mm = Histogram(torch.linspace(-1, 3, 40001))
+        self.batch_latency = []
+        self.count_obj_ci = 0
+        self.count_obj_mm = 0
+        # insertion steps decided by the cheapest-insertion fallback of the deadline-aware rollout
+        self.fallback_steps = 0
+        self.fallback_instances = 0
+
+    def update(self, final_obj, cheapest_ins_obj, mm_obj, batch_time, fallback_steps = None):
+        final_obj = final_obj.detach().view(-1).cpu().float()
+        gap_ci = (final_obj - cheapest_ins_obj.view(-1).cpu()) / cheapest_ins_obj.view(-1).cpu()
+        gap_mm = (final_obj - mm_obj.view(-1).cpu()) / mm_obj.view(-1).cpu()
+        self.final_obj.add(final_obj)
+        self.gap_ci.add(gap_ci)
+        self.gap_mm.add(gap_mm)
+        self.count_obj_ci += int((gap_ci <= 0).sum())
+        self.count_obj_mm += int((gap_mm <= 0).sum())
+        self.batch_latency.append(batch_time)
+        if fallback_steps is not None:
+            self.fallback_steps += int(fallback_steps.sum())
+            self.fallback_instances += int((fallback_steps > 0).sum())
+
+    def gather(self, gather_fn):
+        # merge the accumulators of all distributed ranks, gather_fn concatenates along the first dimension
+        for histogram in (self.final_obj, self.gap_ci, self.gap_mm):
+            histogram.gather(gather_fn)
+        self.batch_latency = gather_fn(torch.tensor(self.batch_latency, dtype=torch.float64)).tolist()
+        counters = gather_fn(torch.tensor([[self.count_obj_ci, self.count_obj_mm, self.fallback_steps, self.fallback_instances]])).sum(0)
+        self.count_obj_ci, self.count_obj_mm, self.fallback_steps, self.fallback_instances = (int(x) for x in counters)
+
+    def __len__(self):
+        return len(self.final_obj)
+
+    def summary(self):
+        n_instances = len(self)
+        if self.batch_latency:
+            values = np.asarray(self.batch_latency)
+            batch_latency = {'count': int(values.size), 'mean': float(values.mean())}
+            for q, v in zip(self.PERCENTILES, np.percentile(values, self.PERCENTILES)):
+                batch_latency['p{}'.format(q)] = float(v)
+        else:
+            batch_latency = {'count': 0}
+        return {
+            'n_instances': n_instances,
+            'count_obj_ci': self.count_obj_ci,
+            'count_obj_mm': self.count_obj_mm,
+            'avg_compute_time_per_instance': sum(self.batch_latency) / max(n_instances, 1),
+            'final_obj': self.final_obj.describe(self.PERCENTILES),
+            'gap_ci': self.gap_ci.describe(self.PERCENTILES),
+            'gap_mm': self.gap_mm.describe(self.PERCENTILES),
+            'batch_latency': batch_latency,
+            'fallback_steps': self.fallback_steps,
+            'fallback_instances': self.fallback_instances,
+        }
+
+    def to_json(self, path, **extra):
+        with open(path, 'w') as f:
+            json.dump({**extra, **self.summary()}, f, indent=True)
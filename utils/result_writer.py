@@ -0,0 +1,66 @@
+import json
+import os
+import numpy as np
+
+
+def result_dtype(graph_size):
+    # one fixed-size record per instance: dataset index, successor array, objective and latency
+    # (the wall time of its batch, the instances of a batch finish together)
+    route_dtype = np.int16 if graph_size <= np.iinfo(np.int16).max else np.int32
+    return np.dtype([('index', np.int64),
+                     ('solution', route_dtype, (graph_size,)),
+                     ('obj', np.float32),
+                     ('latency', np.float32)])
+
+
+class ResultWriter:
+    # append-only binary sink, every batch is written and flushed as soon as it is solved
+    # the records are described by a small json header next to the data file (<path>.json)
+    def __init__(self, path, graph_size):
+        self.path = path
+        self.dtype = result_dtype(graph_size)
+        self.graph_size = graph_size
+        self.count = 0
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.file = open(path, 'wb')
+        self.write_header()
+
+    def write_header(self):
+        with open(self.path + '.json', 'w') as f:
+            json.dump({'graph_size': self.graph_size,
+                       'count': self.count,
+                       'dtype': [(name, self.dtype[name].base.str, self.dtype[name].shape) for name in self.dtype.names]},
+                      f, indent=True)
+
+    def write(self, index, solution, obj, latency):
+        records = np.empty(len(index), dtype=self.dtype)
+        records['index'] = np.asarray(index)
+        records['solution'] = np.asarray(solution)
+        records['obj'] = np.asarray(obj).reshape(-1)
+        records['latency'] = np.asarray(latency).reshape(-1)
+        self.file.write(records.tobytes())
+        self.file.flush()
+        self.count += len(records)
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            self.write_header()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_results(path):
+    # memory-mapped view of a result file, records are read lazily from disk
+    with open(path + '.json') as f:
+        header = json.load(f)
+    dtype = np.dtype([(name, base, tuple(shape)) for name, base, shape in header['dtype']])
+    if header['count'] == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(header['count'],))